@@ -1,9 +1,11 @@
-import json
-import socket
-import re
-import pdb
-from notification import *
-from distribution import *
-from subscription import *
-from web_ui import *
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Miklos Molnar
+#
+# All rights reserved.
+#
+# This software is licensed as described in the file README.md, which
+# you should have received as part of this distribution.
 
+# The components are registered by the modules listed in the trac.plugins
+# entry points of setup.py, importing the package itself is free.
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Miklos Molnar
+#
+# All rights reserved.
+#
+# This software is licensed as described in the file README.md, which
+# you should have received as part of this distribution.
+
+import re
+import time
+from StringIO import StringIO
+
+from trac.admin import IAdminCommandProvider
+from trac.core import Component, TracError, implements
+from trac.notification.api import NotificationSystem
+from trac.resource import ResourceNotFound
+from trac.ticket.model import Ticket
+from trac.ticket.notification import TicketChangeEvent
+from trac.util import as_int
+from trac.util.datefmt import format_datetime, from_utimestamp
+from trac.util.text import print_table, printout
+from trac.util.translation import _
+from trac.wiki.model import WikiPage
+
+from distribution import IrcDistributor
+from journal import DeliveryJournal
+from notification import WikiPageChangeEvent
+from subscription import SubscriptionHandler
+from tracing import QueryCounter
+
+
+class IrkerAdminCommandProvider(Component):
+    """trac-admin commands of the irker notification plugin."""
+
+    implements(IAdminCommandProvider)
+
+    # IAdminCommandProvider methods
+    def get_admin_commands(self):
+        yield ('irker profile', '[count] [functions]',
+               """Replay recent ticket changes and wiki edits under cProfile
+
+               The last <count> ticket changes and the last <count> wiki
+               page versions (100 by default) are run through the whole
+               irc notification pipeline. Nothing is sent to irkerd, the
+               deliveries are only counted, and the subscriptions of the
+               other transports, like email, are matched but not
+               distributed. Prints the events per second, the queries per
+               event and the <functions> (20 by default) hottest
+               functions.
+               """,
+               None, self._do_profile)
+        yield ('irker gc', '[--dry-run]',
+               """Remove the irc subscriptions which cannot match any more
+
+               Removes the duplicated resource ids and the ids of deleted
+               tickets and wiki pages from the resource subscriptions, and
+               the resource subscriptions of deleted sessions. The other
+               subscriptions are kept, a sid without a session is the nick
+               of their target. With --dry-run, only reports what would be
+               removed.
+               """,
+               None, self._do_gc)
+        yield ('irker status', '',
+               """Show the state of the delivery to irkerd
+
+               Prints where the messages are sent to and the last state
+               change of the circuit breaker recorded by any Trac process
+               of the environment.
+               """,
+               None, self._do_status)
+        yield ('irker journal', '<ticket|resource|target> [count]',
+               """Show the last delivery attempts of a ticket or target
+
+               Prints the last <count> (20 by default) messages sent, or
+               not sent, to irkerd from the delivery journal, newest
+               first. The argument is a ticket number like 1234 or #1234,
+               a resource like wiki:WikiStart, or a nick or channel.
+               """,
+               None, self._do_journal)
+
+    def _do_profile(self, count=None, functions=None):
+        import cProfile
+        import pstats
+
+        count = as_int(count, 100, min=1)
+        functions = as_int(functions, 20, min=1)
+        events = self._get_ticket_events(count) + \
+            self._get_wiki_events(count)
+        events.sort(key=lambda event: event.time)
+        if not events:
+            raise TracError(_("There are no ticket changes or wiki page "
+                              "versions to replay."))
+
+        notification_system = NotificationSystem(self.env)
+        profiler = cProfile.Profile()
+        counter = QueryCounter()
+        with IrcDistributor(self.env).dry_run() as deliveries:
+            with counter:
+                start = time.time()
+                profiler.enable()
+                for event in events:
+                    # the other distributors would really send messages
+                    subscriptions = [subscription for subscription in
+                                     notification_system.subscriptions(event)
+                                     if subscription[3] == 'irc']
+                    notification_system.distribute_event(event,
+                                                         subscriptions)
+                profiler.disable()
+                elapsed = time.time() - start
+
+        print_table([
+            (_("Events"), len(events)),
+            (_("Deliveries"), len(deliveries)),
+            (_("Seconds"), '%.3f' % elapsed),
+            (_("Events per second"), '%.1f' % (len(events) / elapsed
+                                               if elapsed else 0)),
+            (_("Queries per event"), '%.1f' % (float(counter.count) /
+                                               len(events))),
+        ])
+        out = StringIO()
+        stats = pstats.Stats(profiler, stream=out)
+        stats.sort_stats('cumulative').print_stats(functions)
+        printout(out.getvalue())
+
+    def _do_gc(self, *args):
+        dry_run = '--dry-run' in args
+        stats = SubscriptionHandler.collect_garbage(self.env, self.log,
+                                                    dry_run)
+        print_table([
+            (_("Duplicated resource ids"), stats['duplicates']),
+            (_("Dangling resource ids"), stats['dangling']),
+            (_("Sessions updated"), stats['sessions']),
+            (_("Subscriptions removed"), stats['rows']),
+        ])
+        printout(_("%(after)d instead of %(before)d resource subscribers "
+                   "are left, with %(ids_after)d instead of %(ids_before)d "
+                   "resource subscriptions.",
+                   after=stats['rows_after'], before=stats['rows_before'],
+                   ids_after=stats['resources_after'],
+                   ids_before=stats['resources_before']))
+        if dry_run:
+            printout(_("Dry run, nothing has been removed."))
+
+    def _do_status(self):
+        distributor = IrcDistributor(self.env)
+        if distributor.relay_socket:
+            destination = _("relay at %(path)s",
+                            path=distributor.relay_socket)
+            if distributor.relay_fallback:
+                destination = _("%(relay)s, or %(host)s:%(port)d while it "
+                                "cannot be reached", relay=destination,
+                                host=distributor.host, port=distributor.port)
+        else:
+            destination = '%s:%d' % (distributor.host, distributor.port)
+        rows = [(_("Destination"), destination),
+                (_("Breaker threshold"), distributor.breaker_threshold),
+                (_("Breaker cooldown"), distributor.breaker_cooldown)]
+        status = distributor.get_breaker_status()
+        if status is None:
+            rows.append((_("Breaker state"),
+                         _("closed, no failures recorded")))
+        else:
+            rows.extend([
+                (_("Breaker state"), status['state']),
+                (_("Changed"), format_datetime(status['updated'])),
+                (_("Changed by process"), status['process']),
+                (_("Consecutive failures"), status['failures']),
+                (_("Rejected deliveries"), status['rejected']),
+                (_("Last error"), status['last_error'] or ''),
+            ])
+            deliveries = status.get('deliveries')
+            if deliveries:
+                rows.append((_("Messages of the process"),
+                             _("%(sent)d sent, %(failed)d failed, "
+                               "%(rejected)d rejected, %(pending)d pending",
+                               **deliveries)))
+            if status['state'] == 'open':
+                retry = status['opened'] + status['cooldown'] - time.time()
+                rows.append((_("Next probe in seconds"),
+                             '%.1f' % max(retry, 0)))
+        print_table(rows)
+
+    def _do_journal(self, what, count=None):
+        count = as_int(count, 20, min=1)
+        journal = DeliveryJournal(self.env)
+        if not journal.path:
+            raise TracError(_("The delivery journal is disabled."))
+        # the attempts of this process are still buffered
+        journal.flush()
+        match = re.match(r'#?(\d+)$', what)
+        if match:
+            entries = journal.find_by_resource('ticket', match.group(1),
+                                               count)
+        elif ':' in what and not what.startswith('#'):
+            realm, id = what.split(':', 1)
+            entries = journal.find_by_resource(realm, id, count)
+        else:
+            entries = journal.find_by_target(what, count)
+        if not entries:
+            printout(_("No delivery attempts of %(what)s were journaled.",
+                       what=what))
+            return
+        print_table([(format_datetime(entry['time']),
+                      '%s:%s %s' % (entry['realm'], entry['id'] or '',
+                                    entry['category']),
+                      entry['target'], entry['status'],
+                      '%.3f' % entry['latency'], '%.3f' % entry['wait'],
+                      entry.get('error') or '')
+                     for entry in entries],
+                    [_("Time"), _("Event"), _("Target"), _("Status"),
+                     _("Seconds"), _("Queued"), _("Error")])
+
+    # helper functions
+    def _get_ticket_events(self, count):
+        events = []
+        for id, t, author in self.env.db_query("""
+                SELECT ticket, time, MIN(author) FROM ticket_change
+                GROUP BY ticket, time ORDER BY time DESC LIMIT %s
+                """, (count,)):
+            try:
+                ticket = Ticket(self.env, id)
+            except ResourceNotFound:
+                continue
+            when = from_utimestamp(t)
+            changes = ticket.get_change(cdate=when)
+            if changes is None:
+                continue
+            events.append(TicketChangeEvent('changed', ticket, when, author,
+                                            changes.get('comment'),
+                                            changes))
+        return events
+
+    def _get_wiki_events(self, count):
+        events = []
+        for name, version, t, author, comment in self.env.db_query("""
+                SELECT name, version, time, author, comment FROM wiki
+                ORDER BY time DESC LIMIT %s
+                """, (count,)):
+            page = WikiPage(self.env, name, version)
+            events.append(WikiPageChangeEvent(
+                'added' if version == 1 else 'changed', page,
+                from_utimestamp(t), author, comment))
+        return events
@@ -0,0 +1,438 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Miklos Molnar
+#
+# All rights reserved.
+#
+# This software is licensed as described in the file README.md, which
+# you should have received as part of this distribution.
+
+"""Benchmarks of the irker notification plugin, run against in-memory
+environments with the Python interpreter of the Trac installation:
+
+    $ python -m irker_notification.benchmark startup [--runs 5]
+    $ python -m irker_notification.benchmark matching [--subscriptions ...]
+    $ python -m irker_notification.benchmark queries [--subscribers ...]
+
+Only the standard library is imported at module level, so that the
+startup benchmark can measure the plugin imports in a fresh interpreter.
+"""
+
+import argparse
+import json
+import math
+import subprocess
+import sys
+import time
+
+PLUGIN_MODULES = ('irker_notification.admin',
+                  'irker_notification.distribution',
+                  'irker_notification.groups',
+                  'irker_notification.journal',
+                  'irker_notification.notification',
+                  'irker_notification.recipients',
+                  'irker_notification.subscription',
+                  'irker_notification.tracing',
+                  'irker_notification.web_ui',
+                  'irker_notification.worker')
+
+
+def create_environment():
+    """Return an in-memory environment with the plugin enabled and
+    synchronous notifications."""
+    from trac.test import EnvironmentStub
+    # the components are registered by the trac.plugins entry points
+    for module in PLUGIN_MODULES:
+        __import__(module)
+    env = EnvironmentStub(default_data=True,
+                          enable=['trac.*', 'irker_notification.*'])
+    env.config.set('irker', 'async_notification', 'false')
+    return env
+
+
+def create_ticket(env, **values):
+    from trac.ticket.model import Ticket
+    ticket = Ticket(env)
+    ticket['summary'] = 'Benchmark'
+    ticket['reporter'] = 'reporter'
+    ticket['owner'] = 'owner'
+    ticket.populate(values)
+    ticket.insert()
+    return ticket
+
+
+def ticket_event(ticket, comment='Benchmark', changes=None):
+    from trac.ticket.notification import TicketChangeEvent
+    return TicketChangeEvent('changed', ticket, None, 'author', comment,
+                             changes or {'fields': {}})
+
+
+# ==================== Startup ====================
+def measure_startup():
+    """Measure the plugin imports and the first and the second event of a
+    fresh interpreter, print them as JSON."""
+    # modules a Trac worker has loaded before the plugins
+    import trac.env
+    import trac.notification.api
+    import trac.test
+    import trac.ticket.notification
+    import trac.web.main
+
+    start = time.time()
+    for module in PLUGIN_MODULES:
+        __import__(module)
+    imported = time.time()
+
+    from trac.notification.api import NotificationSystem
+    from irker_notification.distribution import IrcDistributor
+    from irker_notification.subscription import SubscriptionHandler
+    env = create_environment()
+    SubscriptionHandler.add_subscription(env, env.log, 'user',
+                                         'ResourceChangeIrcSubscriber')
+    SubscriptionHandler.add_resource_subscriptions(env, env.log, 'user',
+                                                   ['/ticket/1'])
+    ticket = create_ticket(env)
+    with IrcDistributor(env).dry_run():
+        first = time.time()
+        NotificationSystem(env).notify(ticket_event(ticket))
+        second = time.time()
+        NotificationSystem(env).notify(ticket_event(ticket))
+        end = time.time()
+    print json.dumps({'import': imported - start,
+                      'first_event': second - first,
+                      'next_event': end - second})
+
+
+def run_startup(args):
+    results = []
+    for i in xrange(args.runs):
+        output = subprocess.check_output([sys.executable, '-m',
+                                          'irker_notification.benchmark',
+                                          '_measure_startup'])
+        results.append(json.loads(output.splitlines()[-1]))
+    print '%-20s %10s %10s' % ('', 'median ms', 'max ms')
+    for name in ('import', 'first_event', 'next_event'):
+        values = sorted(result[name] * 1000 for result in results)
+        print '%-20s %10.2f %10.2f' % (name, values[len(values) // 2],
+                                       values[-1])
+
+
+# ==================== Matching ====================
+MATCHED = 10  # recipients of the benchmark event, whatever the size
+
+
+def populate_sessions(env, count):
+    """Add the authenticated sessions `user0` .. `user<count - 1>`."""
+    env.db_transaction.executemany("""
+        INSERT INTO session (sid, authenticated, last_visit)
+        VALUES (%s, 1, %s)
+        """, [('user%d' % i, int(time.time())) for i in xrange(count)])
+    env.invalidate_known_users_cache()
+
+
+def populate_subscriptions(env, class_name, count):
+    """Add `count` irc subscriptions of `class_name` for the sessions
+    `user0` ... The first `MATCHED` sessions are subscribed to ticket 1,
+    the others to tickets which do not exist."""
+    from trac.util.datefmt import datetime_now, to_utimestamp, utc
+    now = to_utimestamp(datetime_now(utc))
+    with env.db_transaction as db:
+        db.executemany("""
+            INSERT INTO notify_subscription (time, changetime, class, sid,
+                authenticated, distributor, format, priority, adverb)
+            VALUES (%s, %s, %s, %s, 1, 'irc', 'text/irc', 1, 'always')
+            """, [(now, now, class_name, 'user%d' % i)
+                  for i in xrange(count)])
+        if class_name == 'ResourceChangeIrcSubscriber':
+            db.executemany("""
+                INSERT INTO notify_watch (sid, authenticated, class, realm,
+                                          target)
+                VALUES (%s, 1, %s, 'ticket', %s)
+                """, [('user%d' % i, class_name,
+                       '1' if i < MATCHED else str(1000 + i))
+                      for i in xrange(count)])
+
+
+def configure_custom_queries(env, count):
+    """Configure `count` custom queries, only one of them matches the
+    benchmark event."""
+    section = 'irker-custom-queries'
+    env.config.set(section, 'matching', 'Matches the benchmark event')
+    env.config.set(section, 'matching.targets',
+                   ', '.join('user%d' % i for i in xrange(MATCHED)))
+    env.config.set(section, 'matching.conditions', 'status:new')
+    for i in xrange(count - 1):
+        env.config.set(section, 'query%d' % i, 'Query %d' % i)
+        env.config.set(section, 'query%d.targets' % i, 'user%d' % i)
+        env.config.set(section, 'query%d.conditions' % i,
+                       'status:status%d' % i)
+
+
+def measure_matching(class_name, subscriptions, queries, events):
+    """Return the seconds and the queries per event spent in the
+    `matches` method of the subscriber `class_name`."""
+    from trac.core import ComponentMeta
+    from irker_notification.tracing import QueryCounter
+    env = create_environment()
+    # the reporter and the owner are matched by their session ids
+    env.config.set('notification', 'use_short_addr', 'true')
+    # the events are identical, measure the matching rather than the cache
+    env.config.set('irker', 'recipient_cache_size', '0')
+    populate_sessions(env, subscriptions)
+    populate_subscriptions(env, class_name, subscriptions)
+    configure_custom_queries(env, queries)
+    ticket = create_ticket(env, status='new', reporter='user0',
+                           owner='user1')
+    subscriber = [cls for cls in ComponentMeta._components
+                  if cls.__name__ == class_name][0](env)
+    # the first event parses the configuration
+    matched = len(list(subscriber.matches(ticket_event(ticket))))
+    counter = QueryCounter()
+    timings = []
+    with counter:
+        for i in xrange(events):
+            event = ticket_event(ticket)
+            start = time.time()
+            list(subscriber.matches(event))
+            timings.append(time.time() - start)
+    timings.sort()
+    env.reset_db()
+    return timings[len(timings) // 2], float(counter.count) / events, \
+        matched
+
+
+def growth_exponent(points):
+    """Return the slope of the log-log least squares fit of the (size,
+    cost) points: 0 for constant, 1 for linear cost."""
+    xs = [math.log(size) for size, cost in points]
+    ys = [math.log(max(cost, 1e-9)) for size, cost in points]
+    mean_x = sum(xs) / len(xs)
+    mean_y = sum(ys) / len(ys)
+    variance = sum((x - mean_x) ** 2 for x in xs)
+    if not variance:
+        return 0.0
+    return sum((x - mean_x) * (y - mean_y)
+               for x, y in zip(xs, ys)) / variance
+
+
+def run_matching(args):
+    subscriptions = [int(x) for x in args.subscriptions.split(',')]
+    queries = [int(x) for x in args.queries.split(',')]
+    curves = [(name, 'subscriptions', args.max_exponent,
+               [(size, (name, size, min(queries))) for size in subscriptions])
+              for name in ('ResourceChangeIrcSubscriber',
+                           'CustomQueryIrcSubscriber',
+                           'TicketReporterAndOwnerSubscriber')]
+    curves.append(('CustomQueryIrcSubscriber', 'custom queries',
+                   args.max_query_exponent,
+                   [(size, ('CustomQueryIrcSubscriber', min(subscriptions),
+                            size)) for size in queries]))
+    failed = []
+    for name, dimension, bound, sizes in curves:
+        print '%s by %s' % (name, dimension)
+        print '%10s %12s %12s %10s' % ('size', 'ms/event', 'queries',
+                                       'matched')
+        points = []
+        for size, params in sizes:
+            elapsed, queries_per_event, matched = \
+                measure_matching(*params, events=args.events)
+            points.append((size, elapsed))
+            print '%10d %12.3f %12.1f %10d' % (size, elapsed * 1000,
+                                                queries_per_event, matched)
+        exponent = growth_exponent(points)
+        verdict = 'ok' if exponent <= bound else 'FAILED'
+        print 'growth exponent %.2f (bound %.2f) %s\n' % (exponent, bound,
+                                                          verdict)
+        if exponent > bound:
+            failed.append('%s by %s' % (name, dimension))
+    if failed:
+        print 'Per-event cost grows faster than the bound: %s' % \
+            ', '.join(failed)
+        return 1
+    return 0
+
+
+# ==================== Query counts ====================
+def query_origins(spans, origins):
+    """Add the queries of the spans, less the ones of their children, to
+    the `origins` dictionary by span name."""
+    for span in spans:
+        own = span.counter.count - sum(child.counter.count
+                                       for child in span.children)
+        origins[span.name] = origins.get(span.name, 0) + own
+        query_origins(span.children, origins)
+    return origins
+
+
+def count_queries(subscribers):
+    """Notify a ticket change matching `subscribers` recipients of each
+    subscriber class. Return the queries by origin and the number of
+    deliveries."""
+    from trac.notification.api import NotificationSystem
+    from irker_notification.distribution import IrcDistributor
+    from irker_notification.tracing import QueryCounter
+    env = create_environment()
+    # spans are recorded but never written, unless an event takes days
+    env.config.set('irker', 'trace_slow_threshold', str(10 ** 6))
+    env.config.set('notification', 'use_short_addr', 'true')
+    env.config.set('irker', 'recipient_cache_size', '0')
+    populate_sessions(env, subscribers)
+    for class_name in ('ResourceChangeIrcSubscriber',
+                       'CustomQueryIrcSubscriber',
+                       'TicketReporterAndOwnerSubscriber'):
+        populate_subscriptions(env, class_name, subscribers)
+    with env.db_transaction as db:
+        db.executemany("""
+            INSERT INTO notify_watch (sid, authenticated, class, realm,
+                                      target)
+            VALUES (%s, 1, 'ResourceChangeIrcSubscriber', 'ticket', '1')
+            """, [('user%d' % i,) for i in xrange(MATCHED, subscribers)])
+        # half of the recipients have an irc nick
+        db.executemany("""
+            INSERT INTO session_attribute (sid, authenticated, name, value)
+            VALUES (%s, 1, 'irc_nick', %s)
+            """, [('user%d' % i, 'nick%d' % i)
+                  for i in xrange(0, subscribers, 2)])
+    section = 'irker-custom-queries'
+    for i in xrange(3):
+        env.config.set(section, 'involved%d' % i, 'Involved %d' % i)
+        env.config.set(section, 'involved%d.targets' % i,
+                       ', '.join('user%d' % j for j in xrange(subscribers)))
+        env.config.set(section, 'involved%d.conditions' % i,
+                       'involved:user%d' % i)
+    ticket = create_ticket(env, status='new', reporter='user0',
+                           owner='user1')
+    ticket['owner'] = 'user2'
+    ticket.save_changes('author', 'Reassigned')
+
+    counter = QueryCounter()
+    with IrcDistributor(env).dry_run() as deliveries:
+        # the first event parses the configuration
+        NotificationSystem(env).notify(ticket_event(ticket))
+        del deliveries[:]
+        event = ticket_event(ticket)
+        with counter:
+            NotificationSystem(env).notify(event)
+    origins = query_origins(event._irker_trace.spans, {})
+    # the subscribers of Trac itself
+    origins['outside the plugin'] = counter.count - \
+        sum(origins.itervalues())
+
+    # a change nobody is subscribed to
+    ticket = create_ticket(env, status='new', reporter='nobody',
+                           owner='nobody')
+    with IrcDistributor(env).dry_run():
+        event = ticket_event(ticket)
+        with QueryCounter():
+            NotificationSystem(env).notify(event)
+    unmatched = sum(query_origins(event._irker_trace.spans, {}).itervalues())
+    env.reset_db()
+    return origins, counter.count, len(deliveries), unmatched
+
+
+def in_chunks(recipients):
+    """Return the number of IN lists in which `recipients` are looked up
+    by a single query each."""
+    from irker_notification.subscription import in_chunk_size
+    return max((recipients + in_chunk_size - 1) // in_chunk_size, 1)
+
+
+def check_queries(sizes, results, max_queries):
+    """Return the messages of the failed checks of the `count_queries`
+    results for the numbers of recipients `sizes`. The queries of an
+    origin may only grow with the number of IN lists of the recipients,
+    and the events whose recipients fit in one IN list must not take
+    more than `max_queries`."""
+    failed = []
+    names = sorted(set(name for origins, total, sent, unmatched in results
+                       for name in origins))
+    growing = []
+    for name in names:
+        base = results[0][0].get(name, 0)
+        for size, (origins, total, sent, unmatched) in zip(sizes, results):
+            if origins.get(name, 0) * in_chunks(sizes[0]) > \
+                    base * in_chunks(size):
+                growing.append(name)
+                break
+    if growing:
+        failed.append('The queries grow with the subscribers: %s' %
+                      ', '.join(growing))
+    if any(total > max_queries
+           for size, (origins, total, sent, unmatched) in zip(sizes, results)
+           if in_chunks(size) == 1):
+        failed.append('More than %d queries per event' % max_queries)
+    return failed
+
+
+def run_queries(args):
+    sizes = [int(x) for x in args.subscribers.split(',')]
+    results = [count_queries(size) for size in sizes]
+    names = sorted(set(name for origins, total, sent, unmatched in results
+                       for name in origins))
+    print '%-45s' % 'subscribers' + \
+        ''.join('%8d' % size for size in sizes)
+    for name in names:
+        counts = [origins.get(name, 0)
+                  for origins, total, sent, unmatched in results]
+        print '%-45s' % name + ''.join('%8d' % count for count in counts)
+    totals = [total for origins, total, sent, unmatched in results]
+    print '%-45s' % 'total' + ''.join('%8d' % total for total in totals)
+    print '%-45s' % 'deliveries' + \
+        ''.join('%8d' % sent for origins, total, sent, unmatched in results)
+    print '%-45s' % 'plugin queries of an unmatched event' + \
+        ''.join('%8d' % unmatched
+                for origins, total, sent, unmatched in results)
+    failed = check_queries(sizes, results, args.max_queries)
+    for message in failed:
+        print message
+    return 1 if failed else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m irker_notification.benchmark',
+        description=__doc__.split('\n')[0])
+    commands = parser.add_subparsers(dest='command')
+    startup = commands.add_parser('startup', help="plugin import and first "
+                                                  "event latency")
+    startup.add_argument('--runs', type=int, default=5,
+                         help="number of fresh interpreters (5)")
+    startup.set_defaults(func=run_startup)
+    matching = commands.add_parser('matching', help="per-event cost of the "
+                                                    "subscribers by the "
+                                                    "number of subscriptions")
+    matching.add_argument('--subscriptions', default='10,100,1000,10000,'
+                                                     '100000',
+                          help="comma separated numbers of subscriptions "
+                               "(10,100,1000,10000,100000)")
+    matching.add_argument('--queries', default='10,100,1000',
+                          help="comma separated numbers of custom queries "
+                               "(10,100,1000)")
+    matching.add_argument('--events', type=int, default=50,
+                          help="events per size (50)")
+    matching.add_argument('--max-exponent', type=float, default=0.25,
+                          help="maximum growth exponent of the per-event "
+                               "cost by the number of subscriptions, 0 is "
+                               "constant and 1 linear (0.25)")
+    matching.add_argument('--max-query-exponent', type=float, default=1.1,
+                          help="maximum growth exponent of the per-event "
+                               "cost by the number of custom queries (1.1)")
+    matching.set_defaults(func=run_matching)
+    queries = commands.add_parser('queries', help="queries per event by "
+                                                  "origin, by the number of "
+                                                  "recipients")
+    queries.add_argument('--subscribers', default='10,100,1000',
+                         help="comma separated numbers of recipients of each "
+                              "subscriber (10,100,1000)")
+    queries.add_argument('--max-queries', type=int, default=10,
+                         help="maximum queries per event, when the "
+                              "recipients fit in one IN list (10)")
+    queries.set_defaults(func=run_queries)
+    commands.add_parser('_measure_startup').set_defaults(
+        func=lambda args: measure_startup())
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Miklos Molnar
+#
+# All rights reserved.
+#
+# This software is licensed as described in the file README.md, which
+# you should have received as part of this distribution.
+
+import threading
+import time
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitBreaker(object):
+    """Stops the deliveries to an unreachable irkerd.
+
+    After `threshold` consecutive failures the breaker opens and the
+    deliveries fail immediately for `cooldown` seconds. Then a single
+    delivery is let through as a probe: its success closes the breaker,
+    its failure opens it for another cooldown period.
+
+    `on_change(status)` is called whenever the state changes.
+    """
+
+    def __init__(self, threshold, cooldown, on_change=None):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.on_change = on_change
+        self.state = CLOSED
+        self.failures = 0
+        self.rejected = 0
+        self.opened = None
+        self.last_error = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Return whether a delivery may be attempted now."""
+        with self._lock:
+            changed = None
+            if self.state == OPEN and \
+                    time.time() >= self.opened + self.cooldown:
+                changed = self._set_state(HALF_OPEN)
+            if self.state == CLOSED:
+                allowed = True
+            elif self.state == HALF_OPEN and not self._probing:
+                self._probing = allowed = True
+            else:
+                self.rejected += 1
+                allowed = False
+        self._notify(changed)
+        return allowed
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened = None
+            self._probing = False
+            changed = self._set_state(CLOSED)
+        self._notify(changed)
+
+    def failure(self, error):
+        with self._lock:
+            self.failures += 1
+            self.last_error = error
+            self._probing = False
+            changed = None
+            if self.state == HALF_OPEN or \
+                    0 < self.threshold <= self.failures:
+                self.opened = time.time()
+                changed = self._set_state(OPEN)
+        self._notify(changed)
+
+    def status(self):
+        """Return the state of the breaker as a dictionary."""
+        with self._lock:
+            return self._status()
+
+    def _set_state(self, state):
+        if state == self.state:
+            return None
+        self.state = state
+        return self._status()
+
+    def _notify(self, status):
+        if status is not None and self.on_change is not None:
+            self.on_change(status)
+
+    def _status(self):
+        return {'state': self.state, 'failures': self.failures,
+                'rejected': self.rejected, 'opened': self.opened,
+                'cooldown': self.cooldown, 'last_error': self.last_error}
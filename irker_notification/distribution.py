@@ -7,19 +7,27 @@
 # This software is licensed as described in the file README.md, which
 # you should have received as part of this distribution.
 
-import pdb
 import json
+import os
 import socket
 import time
+from contextlib import contextmanager
+from functools import partial
 from trac.env import IEnvironmentSetupParticipant
-from trac.config import (BoolOption, ConfigurationError, IntOption, Option,
-                         OrderedExtensionsOption)
-from trac.core import (Component, ExtensionPoint, Interface,
-                       TracError, implements)
+from trac.config import (BoolOption, ConfigSection, FloatOption,
+                         IntOption, Option, OrderedExtensionsOption)
+from trac.core import Component, ExtensionPoint, Interface, implements
+from trac.util import lazy
 from trac.util.text import exception_to_unicode
-from trac.util.translation import _
 from trac.notification.api import (INotificationDistributor,
                                    INotificationFormatter)
+from engine import get_engine
+from journal import DeliveryJournal
+from recipients import RecipientCache, event_key
+from scheduler import DeliveryScheduler
+from subscription import IrkerGarbageCollector, in_chunk_size
+from tracing import IrkerTracer
+from worker import IrkerNotificationWorker
 
 
 class IIrcAddressResolver(Interface):
@@ -33,6 +41,15 @@ class IIrcAddressResolver(Interface):
             :return: an irc id or `None`
             """
 
+        def get_targets_for_sessions(sessions):
+            """Map several sessions to irc ids at once. Optional, resolvers
+            without this method are called once per session.
+
+            :param sessions: a list of (sid, authenticated) tuples
+            :return: a dictionary mapping the (sid, authenticated) tuples
+                     to irc ids, sessions without irc id can be omitted
+            """
+
 
 class SessionIrcResolver(Component):
     """Gets the email address from the user preferences / session."""
@@ -55,6 +72,23 @@ class SessionIrcResolver(Component):
             # if there is no match use the session id as fallback
             return sid
 
+    def get_targets_for_sessions(self, sessions):
+        # if there is no match use the session id as fallback
+        targets = dict(((sid, int(authenticated)), sid)
+                       for sid, authenticated in sessions)
+        sids = sorted(set(sid for sid, authenticated in targets))
+        for i in xrange(0, len(sids), in_chunk_size):
+            chunk = sids[i:i + in_chunk_size]
+            for sid, authenticated, value in self.env.db_query("""
+                    SELECT sid, authenticated, value
+                      FROM session_attribute
+                     WHERE name=%%s AND sid IN (%s)
+                    """ % ','.join(['%s'] * len(chunk)),
+                    ['irc_nick'] + chunk):
+                if value and (sid, authenticated) in targets:
+                    targets[(sid, authenticated)] = value
+        return targets
+
 
 class IrcDistributor(Component):
     """Distributes notification events as irc messages."""
@@ -68,6 +102,82 @@ class IrcDistributor(Component):
         Option('irker', 'target_host', 'irc://localhost/',
                doc="IRC server URL to which notifications are to be sent.")
 
+    connect_timeout = \
+        FloatOption('irker', 'connect_timeout', 5.0,
+                    doc="""Seconds to wait for the connection to irkerd, or
+                    to the relay.""")
+
+    send_timeout = \
+        FloatOption('irker', 'send_timeout', 5.0,
+                    doc="""Seconds to wait for irkerd, or the relay, to
+                    accept a message.""")
+
+    breaker_threshold = \
+        IntOption('irker', 'breaker_threshold', 5,
+                  doc="""Number of consecutive failed deliveries after
+                  which the messages are dropped without trying to reach
+                  irkerd, until `breaker_cooldown` has passed. 0 disables
+                  the circuit breaker.""")
+
+    breaker_cooldown = \
+        FloatOption('irker', 'breaker_cooldown', 30.0,
+                    doc="""Seconds after which a single delivery probes
+                    irkerd again once the circuit breaker has opened.""")
+
+    rate_limit = \
+        FloatOption('irker', 'rate_limit', 0,
+                    doc="""Messages per second sent to irkerd, or to the
+                    relay, by the process. 0 means unlimited. Senders wait
+                    for their turn, so a limit is best combined with
+                    `async_ticket_delivery`.""")
+
+    rate_burst = \
+        IntOption('irker', 'rate_burst', 20,
+                  doc="""Messages sent at once after a quiet period when
+                  `rate_limit` is set.""")
+
+    async_delivery = \
+        BoolOption('irker', 'async_ticket_delivery', 'false',
+                   doc="""Resolve, format and send the irc notifications of
+                   events raised by Trac itself, like ticket changes, in the
+                   background thread of the notification worker. Wiki
+                   events are always processed by the worker, see
+                   `async_notification`.""")
+
+    relay_socket = \
+        Option('irker', 'relay_socket', '',
+               doc="""Path of the Unix domain socket of an `irker-relay`
+               process. If set, messages are handed over to the relay, which
+               keeps one connection to irkerd for all the Trac processes of
+               the host, instead of connecting to irkerd for each
+               message.""")
+
+    relay_fallback = \
+        BoolOption('irker', 'relay_fallback', 'true',
+                   doc="""Send the messages directly to irkerd at `host` and
+                   `port` while the `relay_socket` cannot be reached. If
+                   disabled, the messages fail until the relay is
+                   back.""")
+
+    nick_priority = \
+        IntOption('irker', 'nick_priority', 10,
+                  doc="""Delivery priority of the direct messages to nicks.
+                  Lower numbers are sent first, the targets of the same
+                  priority take turns.""")
+
+    channel_priority = \
+        IntOption('irker', 'channel_priority', 20,
+                  doc="""Delivery priority of the messages to channels.
+                  Lower numbers are sent first.""")
+
+    priorities_section = \
+        ConfigSection('irker-priorities',
+                      doc="""Delivery priorities of the recipients per
+                      subscriber class, e.g.
+                      `TicketReporterAndOwnerSubscriber = 0`. They override
+                      `nick_priority` and `channel_priority`, and are
+                      overridden by the `priority` of a custom query.""")
+
     formatters = ExtensionPoint(INotificationFormatter)
 
     resolvers =\
@@ -80,6 +190,61 @@ class IrcDistributor(Component):
                                 resolvers will not be called.
                                 """)
 
+    def __init__(self):
+        self._captured = None
+
+    @lazy
+    def engine(self):
+        """The `DeliveryEngine` shared by the environments of the process
+        which send to the same irkerd, or relay. The timeouts and rate
+        settings of the first environment apply to all of them, the
+        circuit breaker is the environment's own."""
+        fallback = None
+        if self.relay_socket:
+            endpoint = ('unix', self.relay_socket)
+            if self.relay_fallback:
+                fallback = ('tcp', self.host, self.port)
+        else:
+            endpoint = ('tcp', self.host, self.port)
+        engine = get_engine(endpoint, fallback,
+                            connect_timeout=self.connect_timeout,
+                            send_timeout=self.send_timeout,
+                            rate=self.rate_limit, burst=self.rate_burst)
+        engine.register(self.env.path, self._breaker_changed,
+                        self.breaker_threshold, self.breaker_cooldown,
+                        self.log)
+        return engine
+
+    @property
+    def breaker(self):
+        """The `CircuitBreaker` guarding the deliveries to irkerd."""
+        return self.engine.breaker(self.env.path)
+
+    def get_delivery_stats(self):
+        """Return the number of messages of the environment queued, sent,
+        failed, rejected by the circuit breaker and pending in this
+        process."""
+        return self.engine.stats(self.env.path)
+
+    def get_breaker_status(self):
+        """Return the last state change of the circuit breaker recorded by
+        any process of the environment, or `None`."""
+        for value, in self.env.db_query("""
+                SELECT value FROM system WHERE name='irker_breaker'
+                """):
+            return json.loads(value)
+
+    @contextmanager
+    def dry_run(self):
+        """Capture the deliveries as (target, message) tuples instead of
+        sending them to irkerd. Events are distributed synchronously while
+        the returned list is active."""
+        self._captured = captured = []
+        try:
+            yield captured
+        finally:
+            self._captured = None
+
     # IEnvironmentSetupParticipant
     def environment_created(self):
         section = 'notification-subscriber'
@@ -105,6 +270,28 @@ class IrcDistributor(Component):
     def distribute(self, transport, recipients, event):
         if transport != 'irc':
             return
+        # a dry run, like `irker profile`, must not change the environment
+        if self._captured is None:
+            IrkerGarbageCollector(self.env).run_if_due()
+        worker = IrkerNotificationWorker(self.env)
+        if self.async_delivery and self._captured is None and \
+                not worker.in_worker_thread():
+            worker.enqueue(self._distribute_record,
+                           (transport, recipients, event))
+            return
+        self._distribute(transport, recipients, event)
+
+    def _distribute_record(self, record):
+        self._distribute(*record)
+
+    def _distribute(self, transport, recipients, event):
+        tracer = IrkerTracer(self.env)
+        with tracer.root_span(event, 'distributor.%s' %
+                              self.__class__.__name__,
+                              recipients=len(recipients)):
+            self._distribute_event(tracer, transport, recipients, event)
+
+    def _distribute_event(self, tracer, transport, recipients, event):
         self.log.debug('irc_distribute: %s / %s / %s' %
                        (transport, event.realm, event.category))
         formats = {}
@@ -120,30 +307,18 @@ class IrcDistributor(Component):
                        "capable of handling '%s' of '%s': %s", transport,
                        event.realm, ', '.join(formats.keys()))
 
-        targets = {}
-        for sid, authed, target, fmt in recipients:
-            if fmt not in formats:
-                self.log.debug("IrcDistributor format %s not available for "
-                               "%s %s", fmt, transport, event.realm)
-                continue
-
-            if sid and not target:
-                for resolver in self.resolvers:
-                    target = resolver.get_target_for_session(sid, authed)
-                    if target:
-                        status = 'authenticated' if authed else \
-                                 'not authenticated'
-                        self.log.debug("IrcDistributor found the target "
-                                       "'%s' for '%s (%s)' via %s", target,
-                                       sid, status,
-                                       resolver.__class__.__name__)
-                        break
-            if target:
-                targets.setdefault(fmt, set()).add(target)
-            else:
-                status = 'authenticated' if authed else 'not authenticated'
-                self.log.debug("IrcDistributor was unable to find an "
-                               "address for: %s (%s)", sid, status)
+        origins = event.__dict__.get('_irc_origins', {})
+        key = event_key(event)
+        if key is not None:
+            key = ('IrcDistributor',) + key + \
+                (frozenset(recipients),
+                 tuple(sorted((target, tuple(matched_by))
+                              for target, matched_by in origins.iteritems())))
+        targets, priorities = RecipientCache(self.env).\
+            lookup(key, lambda: self._get_targets(tracer, transport, event,
+                                                  recipients, formats,
+                                                  origins))
+        targets = dict((fmt, set(trgs)) for fmt, trgs in targets.iteritems())
 
         outputs = {}
         failed = []
@@ -151,7 +326,9 @@ class IrcDistributor(Component):
             if fmt not in targets and fmt != 'text/irc':
                 continue
             try:
-                outputs[fmt] = formatter.format(transport, fmt, event)
+                with tracer.span(event, 'formatter.%s' %
+                                 formatter.__class__.__name__, format=fmt):
+                    outputs[fmt] = formatter.format(transport, fmt, event)
             except Exception as e:
                 self.log.warning('IrcDistributor caught exception while '
                                  'formatting %s to %s for %s: %s%s',
@@ -166,18 +343,157 @@ class IrcDistributor(Component):
                 targets.setdefault('text/plain', set()) \
                          .update(targets.pop(fmt, ()))
 
+        deliveries = []
         for fmt, trgs in targets.iteritems():
             self.log.debug("IrcDistributor is sending event as '%s' to: %s",
                            fmt, ', '.join(trgs))
             message = self._create_message(fmt, outputs)
             if message:
-                trgs = set(trgs)
                 for target in trgs:
-                    self._do_send(transport, event, message, target)
+                    deliveries.append((priorities[target], target,
+                                       (transport, event, message, target)))
             else:
                 self.log.warning("IrcDistributor cannot send event '%s' as "
                                  "'%s': %s",
                                  event.realm, fmt, ', '.join(trgs))
+        self._schedule(deliveries)
+
+    def _schedule(self, deliveries):
+        """Send the (priority, target, delivery) tuples in order."""
+        tracer = IrkerTracer(self.env)
+        for priority, target, delivery in deliveries:
+            # the trace is written once the delivery is done
+            tracer.hold(delivery[1])
+        if self._captured is not None:
+            # a dry run captures its own deliveries, in this thread
+            scheduler = DeliveryScheduler()
+            for priority, target, delivery in deliveries:
+                scheduler.put(priority, target, delivery)
+            scheduler.run(self._send_delivery)
+            return
+        engine = self.engine
+        for priority, target, delivery in deliveries:
+            engine.put(self.env.path, priority, target,
+                       partial(self._send_delivery, delivery, time.time()))
+        engine.run(self.env.path)
+
+    def _get_targets(self, tracer, transport, event, recipients, formats,
+                     origins):
+        """Return the irc targets of the recipients by format, and the
+        delivery priority of each target."""
+        targets = {}
+        priorities = {}
+        supported = []
+        for sid, authed, target, fmt in recipients:
+            if fmt not in formats:
+                self.log.debug("IrcDistributor format %s not available for "
+                               "%s %s", fmt, transport, event.realm)
+                continue
+            supported.append((sid, authed, target, fmt))
+        recipients = supported
+        resolved = self._resolve_sessions(tracer, event,
+                                          list(set((sid, authed)
+                                                   for sid, authed, target,
+                                                   fmt in recipients
+                                                   if sid and not target)))
+        for sid, authed, target, fmt in recipients:
+            matched_by = origins.get(target or sid, ())
+            if sid and not target:
+                target = resolved.get((sid, authed))
+            if target:
+                targets.setdefault(fmt, set()).add(target)
+                priority = self._get_priority(target, matched_by)
+                priorities[target] = min(priorities.get(target, priority),
+                                         priority)
+            else:
+                status = 'authenticated' if authed else 'not authenticated'
+                self.log.debug("IrcDistributor was unable to find an "
+                               "address for: %s (%s)", sid, status)
+        return (dict((fmt, frozenset(trgs))
+                     for fmt, trgs in targets.iteritems()), priorities)
+
+    def _resolve_sessions(self, tracer, event, sessions):
+        """Map the sessions to irc ids with the resolvers, in order. The
+        resolvers supporting it get all the unresolved sessions at once."""
+        resolved = {}
+        for resolver in self.resolvers:
+            pending = [session for session in sessions
+                       if session not in resolved]
+            if not pending:
+                break
+            name = resolver.__class__.__name__
+            with tracer.span(event, 'resolver.%s' % name,
+                             sessions=len(pending)):
+                if hasattr(resolver, 'get_targets_for_sessions'):
+                    targets = resolver.get_targets_for_sessions(pending)
+                else:
+                    targets = dict((session,
+                                    resolver.get_target_for_session(*session))
+                                   for session in pending)
+            for (sid, authed), target in targets.iteritems():
+                if target and (sid, authed) not in resolved:
+                    resolved[(sid, authed)] = target
+                    status = 'authenticated' if authed else \
+                             'not authenticated'
+                    self.log.debug("IrcDistributor found the target '%s' "
+                                   "for '%s (%s)' via %s", target, sid,
+                                   status, name)
+        return resolved
+
+    def _get_priority(self, target, matched_by):
+        section = self.priorities_section
+        priority = None
+        for class_name, query_priority in matched_by:
+            if query_priority is None and class_name in section:
+                query_priority = section.getint(class_name)
+            if query_priority is not None:
+                priority = query_priority if priority is None else \
+                           min(priority, query_priority)
+        if priority is not None:
+            return priority
+        if target.startswith('#'):
+            return self.channel_priority
+        return self.nick_priority
+
+    def _send_delivery(self, delivery, queued=None):
+        # the errors of a delivery must not hold up the next ones
+        transport, event, message, target = delivery
+        start = time.time()
+        status, error = 'failed', None
+        try:
+            with IrkerTracer(self.env).span(event, 'sender',
+                                            target=target) as span:
+                status, error = self._do_send(transport, event, message,
+                                              target)
+                span.set('sent', status == 'sent')
+        except Exception as e:
+            error = exception_to_unicode(e)
+            self.log.error("IrcDistributor failed to send to %s: %s",
+                           target, exception_to_unicode(e, traceback=True))
+        finally:
+            IrkerTracer(self.env).release(event)
+        if self._captured is None:
+            DeliveryJournal(self.env).record(event, target, status,
+                                             time.time() - start,
+                                             start - queued if queued
+                                             else 0.0, error)
+
+    def _breaker_changed(self, status):
+        self.log.warning("IrcDistributor circuit breaker is %s after %d "
+                         "failures: %s", status['state'], status['failures'],
+                         status['last_error'])
+        # the breaker of each process records its transitions, so that
+        # they can be inspected by trac-admin
+        status.update(updated=time.time(), process='%s:%d' %
+                      (socket.gethostname(), os.getpid()))
+        try:
+            with self.env.db_transaction as db:
+                db("DELETE FROM system WHERE name='irker_breaker'")
+                db("INSERT INTO system (name, value) VALUES (%s, %s)",
+                   ('irker_breaker', json.dumps(status)))
+        except Exception as e:
+            self.log.warning("IrcDistributor failed to record the circuit "
+                             "breaker state: %s", exception_to_unicode(e))
 
     def _create_message(self, format, outputs):
         if format not in outputs:
@@ -189,17 +505,25 @@ class IrcDistributor(Component):
         return message
 
     def _do_send(self, transport, event, message, target):
+        """Send a message to a target. Return the status of the attempt,
+        'sent', 'failed' or 'rejected' by the circuit breaker, and the
+        error of a failed attempt."""
+        if self._captured is not None:
+            self._captured.append((target, message))
+            return 'sent', None
         if (not target.startswith('#')):
             target = '%s,isnick' % target
         data = {"to": ('%s%s' % (self.target_server, target)).encode('utf-8').
                 strip(), "privmsg": message.encode('utf-8').strip()}
         self.log.info('Send to: %s%s' % (self.target_server, target))
         try:
-            s = socket.create_connection((self.host, self.port))
-            s.sendall(json.dumps(data))
-            s.shutdown(socket.SHUT_RDWR)
-            s.close()
+            sent = self.engine.send(self.env.path, json.dumps(data) + '\n')
         except socket.error, e:
-            self.log.info('Error: %s' % e)
-            return False
-        return True
+            self.log.warning('Failed to send to %s%s: %s', self.target_server,
+                             target, exception_to_unicode(e))
+            return 'failed', exception_to_unicode(e)
+        if not sent:
+            self.log.debug('Circuit breaker is open, dropped message to: '
+                           '%s%s', self.target_server, target)
+            return 'rejected', None
+        return 'sent', None
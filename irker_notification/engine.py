@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Miklos Molnar
+#
+# All rights reserved.
+#
+# This software is licensed as described in the file README.md, which
+# you should have received as part of this distribution.
+
+import errno
+import socket
+import threading
+import time
+from trac.util.text import exception_to_unicode
+
+from breaker import CircuitBreaker
+from relay import IrkerdConnection, TokenBucket
+from scheduler import DeliveryScheduler
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def get_engine(endpoint, fallback=None, **settings):
+    """Return the `DeliveryEngine` of the process for `endpoint`, created
+    with `settings` by the first environment delivering to it.
+
+    :param endpoint: `('tcp', host, port)` for irkerd or `('unix', path)`
+                     for an `irker-relay` socket
+    :param fallback: the irkerd endpoint used while the relay cannot be
+                     reached, or `None`
+    """
+    with _engines_lock:
+        engine = _engines.get((endpoint, fallback))
+        if engine is None:
+            engine = _engines[(endpoint, fallback)] = \
+                DeliveryEngine(endpoint, fallback, **settings)
+        return engine
+
+
+def create_connection(endpoint, connect_timeout, send_timeout):
+    if endpoint[0] == 'unix':
+        return UnixConnection(endpoint[1], connect_timeout, send_timeout)
+    return IrkerdConnection(endpoint[1], endpoint[2], connect_timeout,
+                            send_timeout)
+
+
+def format_endpoint(endpoint):
+    if endpoint[0] == 'unix':
+        return endpoint[1]
+    return '%s:%s' % endpoint[1:]
+
+
+class UnixConnection(IrkerdConnection):
+    """A persistent connection to the Unix domain socket of a relay."""
+
+    def __init__(self, path, timeout=None, send_timeout=None):
+        IrkerdConnection.__init__(self, None, None, timeout, send_timeout)
+        self.address = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.address)
+        except socket.error:
+            sock.close()
+            raise
+        return sock
+
+
+class DeliveryEngine(object):
+    """Sends the irc deliveries of all the environments of the process
+    which use the same irkerd, or relay.
+
+    The environments share a single connection and rate limiter. Each
+    one has its own queue, circuit breaker and counters of the sent,
+    failed and rejected messages, and its deliveries are only sent by
+    its own threads.
+
+    While the relay cannot be reached, the messages are sent to the
+    `fallback` irkerd endpoint, if any, and the relay is tried again
+    every `relay_retry_interval` seconds.
+    """
+
+    relay_retry_interval = 30
+
+    def __init__(self, endpoint, fallback=None, connect_timeout=5.0,
+                 send_timeout=5.0, rate=0, burst=20):
+        self.endpoint = endpoint
+        self.fallback = fallback
+        self.connection = create_connection(endpoint, connect_timeout,
+                                            send_timeout)
+        self.fallback_connection = None
+        if fallback is not None:
+            self.fallback_connection = \
+                create_connection(fallback, connect_timeout, send_timeout)
+        self.limiter = TokenBucket(rate, burst)
+        self._schedulers = {}
+        self._breakers = {}
+        self._stats = {}
+        self._logs = {}
+        self._relay_down = False
+        self._retry_relay_at = 0
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+
+    def register(self, key, on_breaker_change=None, breaker_threshold=5,
+                 breaker_cooldown=30.0, log=None):
+        """Register the environment identified by `key`, with its own
+        circuit breaker. `on_breaker_change(status)` is called on the
+        state changes of the breaker of the environment, with the `stats`
+        of the environment as `deliveries`. The changes of the state of
+        the relay are logged to `log`."""
+        def changed(status):
+            if on_breaker_change is not None:
+                on_breaker_change(dict(status, deliveries=self.stats(key)))
+        with self._lock:
+            if key in self._schedulers:
+                return
+            self._logs[key] = log
+            self._schedulers[key] = DeliveryScheduler()
+            self._breakers[key] = CircuitBreaker(breaker_threshold,
+                                                 breaker_cooldown, changed)
+            self._stats[key] = dict.fromkeys(('queued', 'sent', 'failed',
+                                              'rejected'), 0)
+
+    def breaker(self, key):
+        """Return the `CircuitBreaker` of an environment."""
+        return self._breakers[key]
+
+    def stats(self, key):
+        """Return the delivery counters of an environment."""
+        with self._lock:
+            stats = dict(self._stats.get(key) or {})
+        if stats:
+            stats['pending'] = max(stats['queued'] - stats['sent'] -
+                                   stats['failed'] - stats['rejected'], 0)
+        return stats
+
+    def put(self, key, priority, target, deliver):
+        """Queue `deliver()`, which sends a message of the environment
+        `key` to `target` by calling `send`."""
+        self._count(key, 'queued')
+        self._schedulers[key].put(priority, target, deliver)
+
+    def run(self, key):
+        """Send the queued deliveries of the environment `key`, unless
+        another thread of the environment is already doing so."""
+        self._schedulers[key].run(lambda deliver: deliver())
+
+    def send(self, key, line):
+        """Send a line to the endpoint on behalf of the environment `key`.
+        Return `False` if the circuit breaker of the environment is open,
+        raise `socket.error` if the endpoint cannot be reached."""
+        breaker = self._breakers[key]
+        if not breaker.allow():
+            self._count(key, 'rejected')
+            return False
+        self._wait_for_token()
+        try:
+            self._sendall(key, line)
+        except socket.error, e:
+            self._count(key, 'failed')
+            breaker.failure(exception_to_unicode(e))
+            raise
+        self._count(key, 'sent')
+        breaker.success()
+        return True
+
+    def _sendall(self, key, line):
+        if self._relay_down and self.fallback_connection is not None and \
+                time.time() < self._retry_relay_at:
+            self._write(self.fallback_connection, line)
+            return
+        try:
+            self._write(self.connection, line)
+        except socket.error, e:
+            if self.endpoint[0] == 'unix':
+                self._relay_failed(key, e)
+            if self.fallback_connection is None:
+                raise
+            self._write(self.fallback_connection, line)
+            return
+        if self._relay_down:
+            self._relay_back(key)
+
+    def _write(self, connection, line):
+        # a connection closed by the other end is reopened once, a failed
+        # connect is not retried as it already took `connect_timeout`
+        for attempt in (1, 2):
+            opened = self._open(connection)
+            with self._send_lock:
+                sock = connection.sock
+                try:
+                    if sock is None:
+                        # closed by another thread in the meantime
+                        raise socket.error(errno.EPIPE, "Connection closed")
+                    sock.sendall(line)
+                    return
+                except socket.error:
+                    if connection.sock is sock:
+                        connection.close()
+                    if opened or attempt == 2:
+                        raise
+
+    def _open(self, connection):
+        # connects without holding the send lock, so that an unreachable
+        # endpoint only blocks the calling thread, not the deliveries of
+        # the other environments
+        if connection.sock is not None:
+            return False
+        sock = connection.connect()
+        sock.settimeout(connection.send_timeout)
+        with self._send_lock:
+            if connection.sock is None:
+                connection.sock = sock
+                return True
+        sock.close()
+        return False
+
+    def _relay_failed(self, key, error):
+        with self._lock:
+            self._retry_relay_at = time.time() + self.relay_retry_interval
+            if self._relay_down:
+                return
+            self._relay_down = True
+        if self.fallback is not None:
+            self._log(key, 'warning', "The irker relay at %s cannot be "
+                      "reached (%s), messages are sent to irkerd at %s "
+                      "until it is back. Start irker-relay, or unset "
+                      "[irker] relay_socket.",
+                      format_endpoint(self.endpoint),
+                      exception_to_unicode(error),
+                      format_endpoint(self.fallback))
+        else:
+            self._log(key, 'error', "The irker relay at %s cannot be "
+                      "reached (%s), messages are not sent until it is "
+                      "back. Start irker-relay, unset [irker] relay_socket "
+                      "or enable [irker] relay_fallback.",
+                      format_endpoint(self.endpoint),
+                      exception_to_unicode(error))
+
+    def _relay_back(self, key):
+        with self._lock:
+            if not self._relay_down:
+                return
+            self._relay_down = False
+        if self.fallback_connection is not None:
+            with self._send_lock:
+                self.fallback_connection.close()
+        self._log(key, 'info', "The irker relay at %s is reachable again, "
+                  "messages are sent to it", format_endpoint(self.endpoint))
+
+    def _log(self, key, level, message, *args):
+        log = self._logs.get(key)
+        if log is not None:
+            getattr(log, level)(message, *args)
+
+    def _wait_for_token(self):
+        while True:
+            with self._lock:
+                taken, wait = self.limiter.acquire()
+            if taken:
+                return
+            time.sleep(wait)
+
+    def _count(self, key, name):
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is not None:
+                stats[name] += 1
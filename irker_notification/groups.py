@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Miklos Molnar
+#
+# All rights reserved.
+#
+# This software is licensed as described in the file README.md, which
+# you should have received as part of this distribution.
+
+import threading
+from collections import defaultdict
+from trac.core import Component, ExtensionPoint
+from trac.perm import IPermissionGroupProvider, PermissionSystem
+
+
+class PermissionGroupIndex(Component):
+    """Reverse index of the permission groups to their members.
+
+    The members of a group are the known users, and the users of the
+    permission table, which are in the group according to an
+    `IPermissionGroupProvider` or to the group records of the permission
+    table, directly or through other groups. The index is rebuilt when
+    the permission table or the known users change.
+    """
+
+    group_providers = ExtensionPoint(IPermissionGroupProvider)
+
+    # groups of every user, they would make every user a member
+    _pseudo_groups = ('anonymous', 'authenticated', 'somebody', '')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._index = None
+
+    def get_members(self, group):
+        """Return the user names of the members of `group`."""
+        return self._get_index()[1].get(group, frozenset())
+
+    def get_version(self):
+        """Return a number changing whenever the index is rebuilt."""
+        return self._get_index()[0]
+
+    def _get_index(self):
+        # both are cached by Trac until they change
+        permissions = PermissionSystem(self.env).get_all_permissions()
+        users = self.env.get_known_users(as_dict=True)
+        with self._lock:
+            index = self._index
+            if index is None or index[1] is not permissions and \
+                    index[1] != permissions or index[2] is not users:
+                version = index[0] + 1 if index else 1
+                index = self._index = (version, permissions, users,
+                                       self._build(permissions, users))
+            return index[0], index[3]
+
+    def _build(self, permissions, users):
+        parents = defaultdict(set)
+        for subject, action in permissions:
+            # lower case actions are the groups of the subject
+            if not action.isupper():
+                parents[subject].add(action)
+        all_groups = set().union(*parents.values())
+        subjects = set(users)
+        subjects.update(subject for subject, action in permissions
+                        if subject not in all_groups)
+        subjects.difference_update(self._pseudo_groups)
+        members = defaultdict(set)
+        for user in subjects:
+            groups = set()
+            for provider in self.group_providers:
+                groups.update(provider.get_permission_groups(user) or [])
+            groups.update(parents.get(user, ()))
+            pending = list(groups)
+            while pending:
+                group = pending.pop()
+                for parent in parents.get(group, ()):
+                    if parent not in groups:
+                        groups.add(parent)
+                        pending.append(parent)
+            for group in groups:
+                if group not in self._pseudo_groups:
+                    members[group].add(user)
+        self.log.debug("PermissionGroupIndex indexed %d groups of %d "
+                       "subjects", len(members), len(subjects))
+        # the groups of the providers may have permissions too
+        all_groups.update(members)
+        return dict((group, frozenset(users - all_groups))
+                    for group, users in members.iteritems())
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Miklos Molnar
+#
+# All rights reserved.
+#
+# This software is licensed as described in the file README.md, which
+# you should have received as part of this distribution.
+
+import atexit
+import json
+import os
+import shutil
+import threading
+import time
+import zlib
+from collections import defaultdict
+from contextlib import contextmanager
+from Queue import Empty, Full, Queue
+
+from trac.config import IntOption, Option
+from trac.core import Component
+from trac.util.text import exception_to_unicode
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class DeliveryJournal(Component):
+    """Append-only journal of the delivery attempts of the irc messages.
+
+    Each attempt is a JSON line with the event, the target, the status
+    and the latency. The lines are written in batches by a background
+    thread. The offsets of the lines are indexed by resource and by
+    target in a directory next to the journal, hashed into
+    `index_buckets` files, so that `trac-admin irker journal` only reads
+    the bucket of the key. The journal and its index are rotated
+    together.
+    """
+
+    journal_file = \
+        Option('irker', 'journal_file', 'irker-journal.log',
+               doc="""Name of the delivery journal. Relative paths are
+               resolved against the log directory of the environment.
+               Empty disables the journal.""")
+
+    journal_max_bytes = \
+        IntOption('irker', 'journal_max_bytes', 10 * 1024 * 1024,
+                  doc="""Size of the delivery journal at which it is
+                  rotated. 0 disables the rotation.""")
+
+    journal_backup_count = \
+        IntOption('irker', 'journal_backup_count', 5,
+                  doc="Number of rotated delivery journals to keep.")
+
+    journal_buffer_size = \
+        IntOption('irker', 'journal_buffer_size', 10000,
+                  doc="""Maximum number of delivery attempts waiting to be
+                  written to the journal. Further attempts are not
+                  journaled until the writer catches up.""")
+
+    # lines written at once by the writer thread
+    batch_size = 500
+
+    # files of the index of a journal, a lookup reads one of them
+    index_buckets = 256
+
+    def __init__(self):
+        self._queue = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._dropped = 0
+
+    @property
+    def path(self):
+        """Absolute path of the current journal, or `None`."""
+        path = self.journal_file
+        if not path:
+            return None
+        if not os.path.isabs(path):
+            path = os.path.join(self.env.log_dir, path)
+        return path
+
+    def record(self, event, target, status, latency, wait=0.0, error=None):
+        """Journal a delivery attempt of a message of `event` to `target`.
+
+        :param status: 'sent', 'failed' or 'rejected' by the circuit
+                       breaker
+        :param latency: seconds spent sending the message
+        :param wait: seconds the message waited in the delivery queue
+        :param error: the error of a failed attempt
+        """
+        if not self.journal_file:
+            return
+        try:
+            resource = event.target.resource
+            realm, id = resource.realm, resource.id
+        except AttributeError:
+            realm, id = event.realm, None
+        entry = {'time': round(time.time(), 3), 'realm': realm,
+                 'id': unicode(id) if id is not None else None,
+                 'category': event.category, 'target': target,
+                 'status': status, 'latency': round(latency, 4),
+                 'wait': round(wait, 4)}
+        if error:
+            entry['error'] = error
+        try:
+            self._get_queue().put_nowait(entry)
+        except Full:
+            with self._lock:
+                self._dropped += 1
+                dropped = self._dropped
+            if dropped == 1:
+                self.log.warning("DeliveryJournal buffer is full, delivery "
+                                 "attempts are not journaled")
+
+    def flush(self):
+        """Block until the journaled attempts have been written."""
+        if self._queue is not None:
+            self._queue.join()
+
+    def find_by_resource(self, realm, id, limit=20):
+        """Return the last `limit` attempts of the events of a resource,
+        newest first."""
+        return self._find(self._resource_key(realm, id), limit)
+
+    def find_by_target(self, target, limit=20):
+        """Return the last `limit` attempts to deliver to a nick or
+        channel, newest first."""
+        return self._find(self._target_key(target), limit)
+
+    # helper functions
+    def _resource_key(self, realm, id):
+        return u'%s:%s' % (realm, id if id is not None else '')
+
+    def _target_key(self, target):
+        return u'target:%s' % target
+
+    def _keys(self, entry):
+        return (self._resource_key(entry['realm'], entry['id']),
+                self._target_key(entry['target']))
+
+    def _segments(self, path):
+        return [path] + ['%s.%d' % (path, i)
+                         for i in xrange(1, self.journal_backup_count + 1)]
+
+    def _bucket(self, segment, key):
+        bucket = (zlib.crc32(key) & 0xffffffff) % self.index_buckets
+        return os.path.join(segment + '.index', '%02x' % bucket)
+
+    def _find(self, key, limit):
+        path = self.path
+        if not path:
+            return []
+        key = key.encode('utf-8')
+        prefix = key + '\t'
+        entries = []
+        with self._file_lock(path):
+            for segment in self._segments(path):
+                try:
+                    with open(self._bucket(segment, key), 'rb') as index:
+                        offsets = [int(line[len(prefix):])
+                                   for line in index
+                                   if line.startswith(prefix)]
+                    if not offsets:
+                        continue
+                    with open(segment, 'rb') as journal:
+                        for offset in reversed(offsets):
+                            journal.seek(offset)
+                            entry = json.loads(journal.readline())
+                            if key not in [k.encode('utf-8')
+                                           for k in self._keys(entry)]:
+                                continue
+                            entries.append(entry)
+                            if len(entries) >= limit:
+                                return entries
+                except (IOError, OSError, ValueError):
+                    continue
+        return entries
+
+    def _get_queue(self):
+        with self._lock:
+            if self._queue is None:
+                self._queue = Queue(max(self.journal_buffer_size, 1))
+                self._thread = threading.Thread(
+                    target=self._run, name='DeliveryJournal-%s' % id(self))
+                self._thread.daemon = True
+                self._thread.start()
+                # trac-admin commands exit right after the deliveries
+                atexit.register(self._shutdown)
+            return self._queue
+
+    def _shutdown(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            entries = [self._queue.get()]
+            while len(entries) < self.batch_size:
+                try:
+                    entries.append(self._queue.get_nowait())
+                except Empty:
+                    break
+            try:
+                self._write([entry for entry in entries if entry is not None])
+            except Exception as e:
+                self.log.warning("DeliveryJournal failed to write %d "
+                                 "entries: %s", len(entries),
+                                 exception_to_unicode(e))
+            finally:
+                for entry in entries:
+                    self._queue.task_done()
+            if None in entries:
+                break
+            with self._lock:
+                dropped, self._dropped = self._dropped, 0
+            if dropped:
+                self.log.warning("DeliveryJournal dropped %d delivery "
+                                 "attempts", dropped)
+
+    def _write(self, entries):
+        path = self.path
+        if not entries or not path:
+            return
+        lines = [json.dumps(entry, separators=(',', ':')) + '\n'
+                 for entry in entries]
+        with self._file_lock(path):
+            with open(path, 'ab') as journal:
+                # the offset is the end of the journal, other processes of
+                # the environment may have appended to it
+                journal.seek(0, os.SEEK_END)
+                offset = journal.tell()
+                index = defaultdict(list)
+                for entry, line in zip(entries, lines):
+                    for key in self._keys(entry):
+                        key = key.encode('utf-8')
+                        index[self._bucket(path, key)].append(
+                            '%s\t%d\n' % (key, offset))
+                    offset += len(line)
+                journal.write(''.join(lines))
+            if not os.path.isdir(path + '.index'):
+                os.mkdir(path + '.index')
+            for bucket, index_lines in index.iteritems():
+                with open(bucket, 'ab') as index_file:
+                    index_file.write(''.join(index_lines))
+            if 0 < self.journal_max_bytes <= offset:
+                self._rotate(path)
+
+    def _rotate(self, path):
+        segments = self._segments(path)
+        if os.path.exists(segments[-1]):
+            os.remove(segments[-1])
+        if os.path.isdir(segments[-1] + '.index'):
+            shutil.rmtree(segments[-1] + '.index')
+        for i in xrange(len(segments) - 1, 0, -1):
+            for suffix in ('', '.index'):
+                if os.path.exists(segments[i - 1] + suffix):
+                    os.rename(segments[i - 1] + suffix, segments[i] + suffix)
+
+    @contextmanager
+    def _file_lock(self, path):
+        # serializes the writers and the rotation between the processes
+        if fcntl is None:
+            yield
+            return
+        with open(path + '.lock', 'ab') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
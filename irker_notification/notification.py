@@ -7,20 +7,32 @@
 # This software is licensed as described in the file README.md, which
 # you should have received as part of this distribution.
 
+import atexit
+import threading
+import time
+from string import Formatter
+
+from trac.config import ConfigSection, FloatOption, IntOption
 from trac.core import Component, implements
 from trac.notification.api import (
     NotificationEvent, NotificationSystem, INotificationFormatter)
+from trac.versioncontrol.api import (IRepositoryChangeListener,
+                                     RepositoryManager)
 from trac.web.api import IRequestFilter, ITemplateStreamFilter
 from trac.web.chrome import add_notice
 from trac.wiki.api import IWikiChangeListener
+from trac.wiki.model import WikiPage
+from trac.util import lazy
+from trac.util.text import exception_to_unicode
 from trac.util.translation import _
 
-from genshi.builder import tag
 from genshi.filters.transform import Transformer
 from genshi.input import HTML
-from genshi.output import HTMLSerializer
 
+from recipients import RecipientCache
 from subscription import SubscriptionHandler
+from worker import (ChangesetRecord, IrkerNotificationWorker,
+                    WikiEventRecord)
 
 
 # ==================== Notification events ====================
@@ -35,13 +47,149 @@ class WikiPageChangeEvent(NotificationEvent):
         self.changes = changes or {}
 
 
+class ChangesetEvent(NotificationEvent):
+    """Represent the changesets added to a repository by a single push as
+    one `NotificationEvent`. The target is the repository."""
+
+    def __init__(self, category, target, time, changesets):
+        authors = []
+        for changeset in changesets:
+            if changeset.author not in authors:
+                authors.append(changeset.author)
+        super(ChangesetEvent, self).__init__('changeset', category, target,
+                                             time, ', '.join(authors))
+        self.changesets = changesets
+        self.authors = authors
+        self.comment = changesets[-1].message if changesets else ''
+        self.changes = {}
+
+
 # ==================== Notification formatters ====================
+class MessageTemplate(object):
+    """A message template compiled into a list of literals and field
+    renderers, so rendering a message is a single join."""
+
+    formatter = Formatter()
+
+    def __init__(self, template):
+        self.template = template
+        self.parts = []
+        self.fields = set()
+        for literal, field, spec, conversion in \
+                self.formatter.parse(template):
+            if literal:
+                self.parts.append((literal, None))
+            if field is not None:
+                self.fields.add(field)
+                self.parts.append((field, self._compile_field(spec,
+                                                              conversion)))
+
+    def _compile_field(self, spec, conversion):
+        if conversion == 'r':
+            convert = repr
+        elif conversion == 's':
+            convert = unicode
+        elif conversion is None:
+            convert = None
+        else:
+            raise ValueError("Unknown conversion specifier %s" % conversion)
+        if not spec and not convert:
+            return unicode
+
+        def render_field(value):
+            if convert:
+                value = convert(value)
+            return format(value, spec)
+        return render_field
+
+    def render(self, values, max_length=None, truncated_field='comment',
+               suffix='...'):
+        """Render the template with the values of the referenced fields.
+
+        If the utf-8 encoded message is longer than `max_length` bytes, the
+        `truncated_field` is shortened first, then the message itself.
+        """
+        texts = [render(values[name]) if render else name
+                 for name, render in self.parts]
+        message = u''.join(texts)
+        if not max_length or len(message.encode('utf-8')) <= max_length:
+            return message
+        slots = [i for i, (name, render) in enumerate(self.parts)
+                 if render and name == truncated_field]
+        if slots:
+            fixed = sum(len(text.encode('utf-8'))
+                        for i, text in enumerate(texts) if i not in slots)
+            budget = (max_length - fixed) // len(slots)
+            if budget > 0:
+                value = truncate_bytes(texts[slots[0]], budget, suffix)
+                for i in slots:
+                    texts[i] = value
+                message = u''.join(texts)
+        return truncate_bytes(message, max_length, suffix)
+
+
+def truncate_bytes(text, length, suffix='...'):
+    """Truncate `text` on a word boundary so that its utf-8 encoded form,
+    including the `suffix`, is at most `length` bytes long."""
+    encoded = text.encode('utf-8')
+    if len(encoded) <= length:
+        return text
+    length -= len(suffix)
+    if length <= 0:
+        return u''
+    # never cut a multibyte character in half
+    text = encoded[:length].decode('utf-8', 'ignore')
+    space = text.rfind(' ')
+    if space > 0:
+        text = text[:space]
+    return text + suffix
+
+
 class ShortIrcNotificationFormatter(Component):
 
     implements(INotificationFormatter)
 
+    irker_templates_section = \
+        ConfigSection('irker-templates',
+                      doc="""
+        Message templates of the irc notifications. Templates can be
+        specified per realm (`ticket`, `wikipage`) and per realm and
+        category, the latter taking precedence. Spaces in the category
+        names are replaced by `_`. Templates use the `str.format` syntax
+        with the following fields: `id`, `name`, `summary`, `category`,
+        `author`, `comment`, `url`. Changeset notifications summarize all
+        the changesets of a push, `id` is the revision range, `name` the
+        repository name and `count` the number of changesets. Invalid
+        templates are logged and replaced by the default ones.
+        {{{
+        [irker-templates]
+        ticket = Ticket #{id} | {category} by {author} | {url}
+        ticket.attachment_added = Ticket #{id} | {author} attached a file
+        }}}
+        """)
+
+    max_message_length = \
+        IntOption('irker', 'max_message_length', 400,
+                  doc="""Maximum length of a notification in bytes. Longer
+                  messages are truncated, the comment first, so that they
+                  fit into a single IRC line.""")
+
+    comment_length = \
+        IntOption('irker', 'comment_length', 80,
+                  doc="Number of characters of the comment in a message.")
+
     # Supported styles
-    support_styles = [('text/irc', 'ticket'), ('text/irc', 'wikipage')]
+    support_styles = [('text/irc', 'ticket'), ('text/irc', 'wikipage'),
+                      ('text/irc', 'changeset')]
+
+    default_templates = {
+        'ticket': u"Ticket #{id} | {category} by {author} | "
+                  u"Comment: {comment} | {url}",
+        'wikipage': u"Page '{name}' | {category} by {author} | "
+                    u"Comment: {comment} | {url}",
+        'changeset': u"{name}: {count} new changeset(s) {id} by {author} | "
+                     u"Comment: {comment} | {url}",
+    }
 
     # INotificationFormatter methods
     def get_supported_styles(self, transport):
@@ -52,24 +200,129 @@ class ShortIrcNotificationFormatter(Component):
     def format(self, transport, style, event):
         if transport != 'irc':
             return ''
+        # the message is rendered once per event, whatever the number of
+        # targets and formats it is sent to
+        messages = event.__dict__.setdefault('_irc_messages', {})
+        if style not in messages:
+            messages[style] = self._render(event)
+        return messages[style]
+
+    # helper functions
+    @lazy
+    def templates(self):
+        templates = dict((realm, MessageTemplate(template))
+                         for realm, template
+                         in self.default_templates.iteritems())
+        for option, value in self.irker_templates_section.options():
+            realm, sep, category = option.partition('.')
+            key = (realm, category.replace(' ', '_')) if category else realm
+            try:
+                templates[key] = self._load_template(realm, value)
+            except (ValueError, TypeError, KeyError, IndexError) as e:
+                # a category falls back to the template of its realm
+                self.log.warning("Invalid irc message template [%s] %s, "
+                                 "using the default template: %s",
+                                 self.irker_templates_section.name, option,
+                                 exception_to_unicode(e))
+        return templates
+
+    def _load_template(self, realm, value):
+        template = MessageTemplate(value)
+        unknown = template.fields - set(self._field_getters)
+        if unknown:
+            raise ValueError(_("Unknown fields %(fields)s",
+                               fields=', '.join(sorted(unknown))))
+        # the format specifications fail only when rendered
+        values = dict((field, u'') for field in template.fields)
+        if realm == 'ticket' and 'id' in values:
+            values['id'] = 1
+        if 'count' in values:
+            values['count'] = 1
+        template.render(values)
+        return template
+
+    def _get_template(self, event):
+        category = event.category.replace(' ', '_')
+        return self.templates.get((event.realm, category)) or \
+            self.templates.get(event.realm)
+
+    def _render(self, event):
+        template = self._get_template(event)
+        if template is None:
+            return ''
+        try:
+            return self._render_template(template, event)
+        except (ValueError, TypeError) as e:
+            # a format specification may not fit the values of an event
+            default = self.default_templates.get(event.realm)
+            if default is None or template.template == default:
+                raise
+            self.log.warning("Failed to render the irc message template "
+                             "'%s', using the default template: %s",
+                             template.template, exception_to_unicode(e))
+            return self._render_template(MessageTemplate(default), event)
+
+    def _render_template(self, template, event):
+        values = {}
+        for field in template.fields:
+            getter = self._field_getters.get(field)
+            values[field] = getter(self, event) if getter else ''
+        return template.render(values, self.max_message_length)
 
-        comment = self.smart_truncate(event.comment)
+    def _get_id(self, event):
         if event.realm == 'ticket':
-            return "Ticket #{0} | {1} by {2} | Comment: {3} | {4}" \
-                .format(event.target.id, event.category, event.author,
-                        comment, self.env.abs_href.ticket(event.target.id))
-        if event.realm == 'wikipage':
-            return "Page '{0}' | {1} by {2} | Comment: {3} | {4}" \
-                .format(event.target.name, event.category, event.author,
-                        comment, self.env.abs_href.wiki(event.target.name))
-        return ''
+            return event.target.id
+        if event.realm == 'changeset':
+            revs = [event.changesets[0].rev, event.changesets[-1].rev]
+            return revs[0] if revs[0] == revs[1] else u'%s-%s' % tuple(revs)
+        return event.target.name
+
+    def _get_name(self, event):
+        if event.realm == 'changeset':
+            return event.target.reponame or '(default)'
+        return self._get_id(event)
+
+    def _get_summary(self, event):
+        if event.realm == 'ticket':
+            return event.target['summary'] or ''
+        if event.realm == 'changeset':
+            return event.comment
+        return event.target.name
+
+    def _get_comment(self, event):
+        return self.smart_truncate(event.comment, self.comment_length)
+
+    def _get_url(self, event):
+        if event.realm == 'ticket':
+            return self.env.abs_href.ticket(event.target.id)
+        if event.realm == 'changeset':
+            reponame = event.target.reponame or None
+            first = event.changesets[0].rev
+            last = event.changesets[-1].rev
+            if first == last:
+                return self.env.abs_href.changeset(last, reponame)
+            return self.env.abs_href.log(reponame, rev=last, stop_rev=first)
+        return self.env.abs_href.wiki(event.target.name)
+
+    _field_getters = {
+        'id': _get_id,
+        'name': _get_name,
+        'summary': _get_summary,
+        'category': lambda self, event: event.category,
+        'author': lambda self, event: event.author or '',
+        'comment': _get_comment,
+        'url': _get_url,
+        'count': lambda self, event: len(getattr(event, 'changesets', ())),
+    }
 
-    # helper functions
     def smart_truncate(self, content, length=80, suffix='...'):
+        content = u' '.join((content or u'').split())
         if len(content) <= length:
             return content
-        else:
-            return ' '.join(content[:length + 1].split(' ')[0:-1]) + suffix
+        space = content.rfind(' ', 0, length + 1)
+        if space > 0:
+            return content[:space] + suffix
+        return content[:length] + suffix
 
 
 # ==================== Notification plugin ====================
@@ -81,6 +334,10 @@ class IrkerNotifcationPlugin(Component):
     def pre_process_request(self, req, handler):
         """Handles requests containing subscription related actions
         like subscribe and unsubscribe."""
+        if self._may_change_recipients(req):
+            # the cache is dropped once the handler has written the
+            # change, which is followed by a redirect or a rendering
+            req.add_redirect_listener(self._invalidate_recipients)
         if not req.session.authenticated:
             return handler
         if req.method == 'GET' and 'subscribe' in req.args:
@@ -91,26 +348,29 @@ class IrkerNotifcationPlugin(Component):
                     SubscriptionHandler.add_subscription(
                         self.env, self.log, req.session.sid,
                         'ResourceChangeIrcSubscriber')
-                prev_subs = req.session.get('subscriptions', '')
-                if len(prev_subs) == 0:
-                    req.session['subscriptions'] = req.path_info
-                else:
-                    req.session['subscriptions'] = \
-                        req.session['subscriptions'] + ', %s' % req.path_info
-                req.session.save()
+                SubscriptionHandler.add_resource_subscriptions(
+                    self.env, self.log, req.session.sid, [req.path_info])
                 add_notice(req, _('You have subscribed successfully!'))
             else:
-                updated_subscriptions = \
-                    [x.strip() for x in req.session['subscriptions'].
-                        split(',') if not x.strip() == req.path_info]
-                req.session['subscriptions'] = ', '.join(updated_subscriptions)
-                req.session.save()
+                SubscriptionHandler.remove_subscriptions(
+                    self.env, self.log, req.session.sid, [req.path_info])
                 add_notice(req, _('You have unsubscribed successfully!'))
         return handler
 
     def post_process_request(self, req, template, data, content_type):
+        if self._may_change_recipients(req):
+            self._invalidate_recipients(req)
         return template, data, content_type
 
+    def _may_change_recipients(self, req):
+        # preferences, sessions, permissions or subscriptions may change
+        # the recipients of the notifications
+        return req.method == 'POST' and \
+            req.path_info.startswith(('/prefs', '/admin'))
+
+    def _invalidate_recipients(self, req, *args):
+        RecipientCache(self.env).invalidate()
+
     # ITemplateStreamFilter methods
     def filter_stream(self, req, method, filename, stream, data):
         """Returns a transformed stream extended with irc subscribe button."""
@@ -132,13 +392,20 @@ class IrkerNotifcationPlugin(Component):
         return stream
 
     def wiki_emit_event(self, page, action, time, author):
-        event = WikiPageChangeEvent(action, page, time, author, page.comment)
+        record = WikiEventRecord(action, page.name, page.version, time,
+                                 author, page.comment)
+        IrkerNotificationWorker(self.env).enqueue(self._notify_wiki, record)
+
+    def _notify_wiki(self, record):
+        page = WikiPage(self.env, record.name, record.version or None)
+        event = WikiPageChangeEvent(record.category, page, record.time,
+                                    record.author, record.comment)
         try:
             NotificationSystem(self.env).notify(event)
         except Exception as e:
             self.log.error("Failure sending notification when wiki page"
                            " '%s' has changed: %s ",
-                           page.name, exception_to_unicode(e))
+                           record.name, exception_to_unicode(e))
 
     def wiki_page_added(self, page):
         self.wiki_emit_event(page, 'added', None, page.author)
@@ -173,3 +440,88 @@ class IrkerNotifcationPlugin(Component):
           </div>
         </form>
         ''' % (req.href + req.path_info, button)
+
+
+class IrkerChangesetAnnouncer(Component):
+    """Announces the changesets added to the repositories. The changesets
+    of a push are collected and announced in a single summary message."""
+
+    implements(IRepositoryChangeListener)
+
+    batch_delay = \
+        FloatOption('irker', 'changeset_batch_delay', 2.0,
+                    doc="""Number of seconds without new changesets in a
+                    repository after which the collected changesets are
+                    announced together.""")
+
+    def __init__(self):
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._exit_flush = False
+
+    # IRepositoryChangeListener methods
+    def changeset_added(self, repos, changeset):
+        record = ChangesetRecord(repos.display_rev(changeset.rev),
+                                 changeset.author, changeset.date,
+                                 changeset.message)
+        with self._lock:
+            pending = self._pending.get(repos.reponame)
+            if pending is None:
+                pending = self._pending[repos.reponame] = \
+                    {'changesets': [], 'last': None}
+                self._schedule(repos.reponame, self.batch_delay)
+                if not self._exit_flush:
+                    # trac-admin commands exit right after the changesets
+                    # are added, announce them instead of waiting
+                    atexit.register(self._flush_all)
+                    self._exit_flush = True
+            pending['changesets'].append(record)
+            pending['last'] = time.time()
+
+    def changeset_modified(self, repos, changeset, old_changeset):
+        pass
+
+    # helper functions
+    def _schedule(self, reponame, delay):
+        # the pending batches are announced at exit, the timer does not
+        # hold the process up
+        timer = threading.Timer(max(delay, 0), self._flush, (reponame,))
+        timer.daemon = True
+        timer.start()
+
+    def _flush(self, reponame):
+        with self._lock:
+            pending = self._pending.get(reponame)
+            if pending is None:
+                # already announced at exit
+                return
+            remaining = pending['last'] + self.batch_delay - time.time()
+            if remaining > 0:
+                self._schedule(reponame, remaining)
+                return
+            del self._pending[reponame]
+        IrkerNotificationWorker(self.env).\
+            enqueue(self._notify_changesets,
+                    (reponame, pending['changesets']))
+
+    def _flush_all(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for reponame in sorted(pending):
+            self._notify_changesets((reponame,
+                                     pending[reponame]['changesets']))
+
+    def _notify_changesets(self, record):
+        reponame, changesets = record
+        repos = RepositoryManager(self.env).get_repository(reponame)
+        if repos is None:
+            return
+        event = ChangesetEvent('added', repos, changesets[-1].date,
+                               changesets)
+        try:
+            NotificationSystem(self.env).notify(event)
+        except Exception as e:
+            self.log.error("Failure sending notification about %d "
+                           "changesets of repository '%s': %s",
+                           len(changesets), reponame or '(default)',
+                           exception_to_unicode(e))
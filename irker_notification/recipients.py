@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Miklos Molnar
+#
+# All rights reserved.
+#
+# This software is licensed as described in the file README.md, which
+# you should have received as part of this distribution.
+
+import threading
+from collections import OrderedDict, defaultdict
+from trac.cache import cached
+from trac.config import IntOption
+from trac.core import Component
+
+from groups import PermissionGroupIndex
+
+
+def event_key(event, fields=(), changed=()):
+    """Return the part of a cache key identifying the recipients of
+    `event`, or `None` for events whose recipients are not cached.
+
+    :param fields: names of the ticket fields the recipients depend on
+    :param changed: names of the ticket fields whose new value in the
+                    changes of the event the recipients depend on
+    """
+    if event.realm not in ('ticket', 'wikipage'):
+        return None
+    resource = event.target.resource
+    key = (resource.realm, unicode(resource.id), event.category)
+    if event.realm != 'ticket':
+        return key
+    if fields:
+        key += tuple(event.target[name] for name in fields)
+    if changed:
+        changes = (event.changes or {}).get('fields', {})
+        key += tuple(changes.get(name, {}).get('new') for name in changed)
+    return key
+
+
+class RecipientCache(Component):
+    """Bounded LRU cache of the recipients of the ticket and wiki events.
+
+    Consecutive events of the same resource, with the same values of the
+    fields the subscribers depend on, reuse the subscriptions matched
+    and the irc targets resolved for the first one. The whole cache is
+    dropped by every process whenever a subscription, a session or a
+    permission changes, including the changes made with `trac-admin`,
+    which are noticed through the `PermissionGroupIndex`.
+    """
+
+    cache_size = \
+        IntOption('irker', 'recipient_cache_size', 1000,
+                  doc="""Number of recipient sets of ticket and wiki events
+                  kept in memory. 0 disables the cache.""")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+
+    @cached
+    def _entries(self):
+        # a new generation starts with an empty cache
+        return OrderedDict()
+
+    def lookup(self, key, compute):
+        """Return the value cached for `key`, or cache and return the
+        result of `compute()`. Nothing is cached when `key` is `None`."""
+        if key is None or self.cache_size <= 0:
+            return compute()
+        # the value is stored in the generation it was computed in
+        entries = self._entries
+        # permissions and known users are also changed by trac-admin,
+        # which does not invalidate the cache
+        version = PermissionGroupIndex(self.env).get_version()
+        with self._lock:
+            if version != self._version:
+                entries.clear()
+                self._version = version
+            value = entries.pop(key, None)
+            if value is not None:
+                entries[key] = value
+                return value
+        value = compute()
+        with self._lock:
+            entries[key] = value
+            while len(entries) > self.cache_size:
+                entries.popitem(last=False)
+        return value
+
+    def invalidate(self):
+        """Start a new generation of the cache and of the
+        `SubscriptionFilter`, in every process of the environment."""
+        del self._entries
+        SubscriptionFilter(self.env).invalidate()
+
+
+class SubscriptionFilter(Component):
+    """In-memory pre-filter of the subscriptions of the irc subscribers.
+
+    It holds the ids of the resources watched by somebody and the
+    sessions subscribed to each subscriber class, whatever the
+    distributor of their rule, so that the subscribers can reject most
+    events with a few set lookups instead of database queries. It is
+    rebuilt after the subscriptions change, together with the
+    `RecipientCache`.
+    """
+
+    @cached
+    def _index(self):
+        watched = set(self.env.db_query("""
+            SELECT DISTINCT realm, target FROM notify_watch WHERE class=%s
+            """, ('ResourceChangeIrcSubscriber',)))
+        subscribers = defaultdict(set)
+        # the rules of the other distributors, e.g. email rules set in
+        # the notification preferences of Trac, are matched too
+        for class_name, sid in self.env.db_query("""
+                SELECT DISTINCT class, sid FROM notify_subscription
+                """):
+            subscribers[class_name].add(sid)
+        return frozenset(watched), \
+            dict((class_name, frozenset(sids))
+                 for class_name, sids in subscribers.iteritems())
+
+    def is_watched(self, realm, id):
+        """Return whether somebody may watch the resource."""
+        return (realm, unicode(id)) in self._index[0]
+
+    def get_subscribers(self, class_name):
+        """Return the session ids and channels having a subscription to
+        the subscriber class."""
+        return self._index[1].get(class_name, frozenset())
+
+    def invalidate(self):
+        del self._index
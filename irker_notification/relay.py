@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Miklos Molnar
+#
+# All rights reserved.
+#
+# This software is licensed as described in the file README.md, which
+# you should have received as part of this distribution.
+
+"""Per-host relay between the Trac worker processes and irkerd.
+
+The workers hand their messages over a Unix domain socket to the relay,
+one JSON object per line, in the format irkerd expects. The relay owns a
+single persistent connection to irkerd, sends the queued messages in
+batches and enforces a rate limit, so the number of worker processes no
+longer multiplies the connections to irkerd.
+
+    $ irker-relay --socket /var/run/irker-relay.sock --irkerd localhost:6659
+"""
+
+import argparse
+import logging
+import os
+import socket
+import threading
+import time
+from collections import deque
+from SocketServer import StreamRequestHandler, ThreadingUnixStreamServer
+
+log = logging.getLogger('irker-relay')
+
+
+class TokenBucket(object):
+    """Rate limiter allowing `rate` messages per second on average and
+    bursts of `burst` messages."""
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = max(float(burst), 1.0)
+        self.tokens = self.burst
+        self.updated = time.time()
+
+    def acquire(self, count=1):
+        """Take up to `count` tokens, return the number of tokens taken
+        and the seconds to wait before the next one is available."""
+        if self.rate <= 0:
+            return count, 0
+        now = time.time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        taken = min(count, int(self.tokens))
+        self.tokens -= taken
+        return taken, 0 if taken else (1 - self.tokens) / self.rate
+
+
+class IrkerdConnection(object):
+    """A persistent connection to irkerd, reopened when it breaks."""
+
+    def __init__(self, host, port, timeout=None, send_timeout=None):
+        self.address = (host, port)
+        self.timeout = timeout
+        self.send_timeout = timeout if send_timeout is None else \
+                            send_timeout
+        self.sock = None
+
+    def connect(self):
+        return socket.create_connection(self.address, self.timeout)
+
+    def sendall(self, data):
+        if self.sock is None:
+            self.sock = self.connect()
+            self.sock.settimeout(self.send_timeout)
+        try:
+            self.sock.sendall(data)
+        except socket.error:
+            self.close()
+            raise
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+            self.sock = None
+
+
+class Relay(object):
+    """Queues the received messages and forwards them to irkerd."""
+
+    def __init__(self, connection, rate=10, burst=20, batch_size=50,
+                 queue_size=10000, retry_delay=5):
+        self.connection = connection
+        self.limiter = TokenBucket(rate, burst)
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.retry_delay = retry_delay
+        self.queue = deque()
+        self.dropped = 0
+        self.cond = threading.Condition()
+
+    def put(self, line):
+        with self.cond:
+            if len(self.queue) >= self.queue_size:
+                self.dropped += 1
+                log.warning("Queue is full, dropping message (%d dropped)",
+                            self.dropped)
+                return
+            self.queue.append(line)
+            self.cond.notify()
+
+    def run(self):
+        """Forward the queued messages, never returns."""
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait()
+                taken, wait = self.limiter.acquire(min(len(self.queue),
+                                                       self.batch_size))
+                batch = [self.queue.popleft() for i in xrange(taken)]
+            if not batch:
+                time.sleep(wait)
+                continue
+            try:
+                self.connection.sendall(''.join(batch))
+            except socket.error as e:
+                log.warning("Sending %d messages to irkerd failed: %s",
+                            len(batch), e)
+                with self.cond:
+                    self.queue.extendleft(reversed(batch))
+                time.sleep(self.retry_delay)
+
+
+class RelayRequestHandler(StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            line = line.strip()
+            if line:
+                self.server.relay.put(line + '\n')
+
+
+class RelayServer(ThreadingUnixStreamServer):
+
+    daemon_threads = True
+
+    def __init__(self, path, relay):
+        if os.path.exists(path):
+            os.unlink(path)
+        ThreadingUnixStreamServer.__init__(self, path, RelayRequestHandler)
+        os.chmod(path, 0o660)
+        self.relay = relay
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='irker-relay',
+                                     description=__doc__.split('\n')[0])
+    parser.add_argument('--socket', required=True,
+                        help="path of the Unix domain socket to listen on")
+    parser.add_argument('--irkerd', default='localhost:6659',
+                        help="irkerd address as host:port (localhost:6659)")
+    parser.add_argument('--rate', type=float, default=10,
+                        help="messages per second sent to irkerd, 0 means "
+                             "unlimited (10)")
+    parser.add_argument('--burst', type=int, default=20,
+                        help="messages sent at once after a quiet period "
+                             "(20)")
+    parser.add_argument('--batch-size', type=int, default=50,
+                        help="maximum messages per write to irkerd (50)")
+    parser.add_argument('--queue-size', type=int, default=10000,
+                        help="maximum queued messages (10000)")
+    parser.add_argument('--timeout', type=float, default=10,
+                        help="irkerd connect and send timeout in seconds "
+                             "(10)")
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else
+                        logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    host, sep, port = args.irkerd.rpartition(':')
+    connection = IrkerdConnection(host or 'localhost', int(port),
+                                  args.timeout)
+    relay = Relay(connection, args.rate, args.burst, args.batch_size,
+                  args.queue_size)
+    sender = threading.Thread(target=relay.run, name='irker-relay-sender')
+    sender.daemon = True
+    sender.start()
+    server = RelayServer(args.socket, relay)
+    log.info("Relaying %s to irkerd at %s", args.socket, args.irkerd)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(args.socket)
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Miklos Molnar
+#
+# All rights reserved.
+#
+# This software is licensed as described in the file README.md, which
+# you should have received as part of this distribution.
+
+import threading
+from collections import deque
+
+
+class DeliveryScheduler(object):
+    """Orders the pending irc deliveries by priority lanes, lower numbers
+    first, and round-robin between the targets of a lane, so that a
+    target with many pending messages cannot hold back the others.
+
+    Any thread can put deliveries, they are sent by whichever thread is
+    running the scheduler at that time.
+    """
+
+    def __init__(self):
+        self._lanes = {}
+        self._lock = threading.Lock()
+        self._running = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(messages) for lane in self._lanes.itervalues()
+                       for messages in lane[1].itervalues())
+
+    def put(self, priority, target, delivery):
+        with self._lock:
+            order, pending = self._lanes.setdefault(priority, (deque(), {}))
+            if target not in pending:
+                pending[target] = deque()
+                order.append(target)
+            pending[target].append(delivery)
+
+    def run(self, send):
+        """Call `send(delivery)` for the pending deliveries in order until
+        there are none left. Returns immediately if another thread is
+        already sending."""
+        while self._lanes:
+            if not self._running.acquire(False):
+                return
+            try:
+                while True:
+                    delivery = self._next()
+                    if delivery is None:
+                        break
+                    send(delivery)
+            finally:
+                self._running.release()
+
+    def _next(self):
+        with self._lock:
+            if not self._lanes:
+                return None
+            priority = min(self._lanes)
+            order, pending = self._lanes[priority]
+            target = order.popleft()
+            messages = pending[target]
+            delivery = messages.popleft()
+            if messages:
+                order.append(target)
+            else:
+                del pending[target]
+                if not order:
+                    del self._lanes[priority]
+            return delivery
@@ -7,17 +7,28 @@
 # This software is licensed as described in the file README.md, which
 # you should have received as part of this distribution.
 
+import threading
+import time
 from collections import defaultdict
-from trac.config import ConfigSection
-from trac.core import Component, Interface, implements, ExtensionPoint
+from trac.config import ConfigSection, IntOption, ListOption
+from trac.core import Component, Interface, implements
 from trac.notification.api import (
-     INotificationSubscriber, NotificationSystem, INotificationFormatter)
+     INotificationSubscriber, NotificationSystem)
 from trac.notification.mail import RecipientMatcher
-from trac.notification.model import Subscription
+from trac.notification.model import Subscription, Watch
+from trac.util import lazy
+from trac.util.text import unicode_unquote
 from trac.util.translation import _
-from trac.perm import IPermissionGroupProvider
 from trac.web.href import Href
 
+from groups import PermissionGroupIndex
+from recipients import RecipientCache, SubscriptionFilter, event_key
+from tracing import traced
+from worker import IrkerNotificationWorker
+
+# parameters of the IN lists of a query, SQLite accepts up to 999
+in_chunk_size = 500
+
 
 # Subscriber interface
 class ISubscriptionInfoProvider(Interface):
@@ -25,15 +36,48 @@ class ISubscriptionInfoProvider(Interface):
            administrative user"""
 
         def get_subscription_info(self):
-            """Map a session id and authenticated flag to an irc id.
+            """Describe the subscriber class for the admin panel.
 
-            :param sid: the session id
-            :param authenticated: 1 for authenticated sessions, 0 otherwise
-            :return: tuple (<Name>, <Description>, <IsConfigurable>,
-                            <Subcribers>)
+            The subscriptions themselves are not returned, they are queried
+            page by page via `SubscriptionHandler.find_subscriptions`.
+
+            :return: tuple (<Name>, <Description>, <IsConfigurable>)
             """
 
 
+def record_origin(event, target, class_name, priority=None):
+    """Remember that the subscriber class `class_name` matched `target`,
+    the session id or irc id of a recipient, with an explicit delivery
+    `priority` if it has one. `IrcDistributor` schedules the deliveries
+    by these origins."""
+    origins = event.__dict__.setdefault('_irc_origins', {})
+    origins.setdefault(target, []).append((class_name, priority))
+
+
+def cached_matches(subscriber, event, match, key):
+    """Yield the subscription tuples yielded by `match(event)`, cached by
+    the `RecipientCache` for the events with the same `key` together with
+    the origins recorded by the subscriber."""
+    class_name = subscriber.__class__.__name__
+    computed = []
+
+    def compute():
+        subs = list(match(event))
+        origins = [(target, priority) for target, matched_by
+                   in event.__dict__.get('_irc_origins', {}).iteritems()
+                   for name, priority in matched_by if name == class_name]
+        computed.append(True)
+        return subs, origins
+
+    subs, origins = RecipientCache(subscriber.env).\
+        lookup(key and (class_name,) + key, compute)
+    if not computed:
+        for target, priority in origins:
+            record_origin(event, target, class_name, priority)
+    for sub in subs:
+        yield sub
+
+
 # Subscriber interface implementations            
 class TicketReporterAndOwnerSubscriber(Component):
     """Allows the users to subscribe to tickets that they report."""
@@ -41,7 +85,12 @@ class TicketReporterAndOwnerSubscriber(Component):
     implements(INotificationSubscriber, ISubscriptionInfoProvider)
 
     # INotificationSubscriber methods
+    @traced
     def matches(self, event):
+        return cached_matches(self, event, self._match,
+                              event_key(event, ('reporter', 'owner')))
+
+    def _match(self, event):
         if event.realm != 'ticket':
             return
         if event.category not in ('created', 'changed', 'attachment added',
@@ -57,12 +106,15 @@ class TicketReporterAndOwnerSubscriber(Component):
                 return
             sid, auth, addr = recipient
 
+            class_name = self.__class__.__name__
+            record_origin(event, addr or sid, class_name)
+
             # Default subscription
             for s in self.default_subscriptions():
                 yield s[0], s[1], sid, auth, addr, s[2], s[3], s[4]
 
-            if sid:
-                class_name = self.__class__.__name__
+            if sid and sid in SubscriptionFilter(self.env).\
+                    get_subscribers(class_name):
                 for s in Subscription \
                         .find_by_sids_and_class(self.env, ((sid, auth),),
                                                 class_name):
@@ -80,10 +132,7 @@ class TicketReporterAndOwnerSubscriber(Component):
 
     # ISubscriptionInfoProvider methods
     def get_subscription_info(self):
-        class_name = self.__class__.__name__
-        subscriptions = Subscription.find_by_class(self.env, class_name)
-        return self.__class__.__name__, self.description(), False, \
-            [(s['sid'], s['id']) for s in subscriptions]
+        return self.__class__.__name__, self.description(), False
 
 
 class ResourceChangeIrcSubscriber(Component):
@@ -93,25 +142,25 @@ class ResourceChangeIrcSubscriber(Component):
     implements(INotificationSubscriber, ISubscriptionInfoProvider)
 
     # INotificationSubscriber methods
+    @traced
     def matches(self, event):
+        return cached_matches(self, event, self._match, event_key(event))
+
+    def _match(self, event):
         class_name = self.__class__.__name__
-        format = 'text/irc'
-        priority = 0
-        href = Href('')
-        resource_id = ''
         if event.realm == 'ticket' or event.realm == 'wikipage':
-            resource = event.target.resource()
-            resource_id = href(resource.realm, resource.id)
+            resource = event.target.resource
         else:
             return
-        # Managed subscriptions
-        for s in Subscription.find_by_class(self.env, class_name):
-            sub = list(s.subscription_tuple())
-            if not SubscriptionHandler.is_session_subscribed_to(self.env,
-               sub[2], resource_id):
-                continue
-            sub[4] = sub[2]
-            sub = tuple(sub)
+        if not SubscriptionFilter(self.env).is_watched(resource.realm,
+                                                       resource.id):
+            return
+        # Managed subscriptions, looked up by the resource
+        for sub in SubscriptionHandler.\
+                find_resource_subscriptions(self.env, class_name,
+                                            resource.realm,
+                                            unicode(resource.id)):
+            record_origin(event, sub[4], class_name)
             yield sub
 
     def description(self):
@@ -126,10 +175,54 @@ class ResourceChangeIrcSubscriber(Component):
 
     # ISubscriptionInfoProvider methods
     def get_subscription_info(self):
+        return self.__class__.__name__, self.description(), True
+
+
+class ChangesetIrcSubscriber(Component):
+    """Implements a policy to send an irc message about the changesets
+       added to the repositories to the configured targets and to the
+       subscribers of this class."""
+
+    implements(INotificationSubscriber, ISubscriptionInfoProvider)
+
+    changeset_targets = \
+        ListOption('irker', 'changeset_targets', '',
+                   doc="""Comma separated list of nicks and channels which
+                   are notified about the changesets added to the
+                   repositories.""")
+
+    # INotificationSubscriber methods
+    @traced
+    def matches(self, event):
+        if event.realm != 'changeset':
+            return
         class_name = self.__class__.__name__
-        subscriptions = Subscription.find_by_class(self.env, class_name)
-        return self.__class__.__name__, self.description(), True, \
-            [(s['sid'], s['id']) for s in subscriptions]
+        for target in self.changeset_targets:
+            record_origin(event, target, class_name)
+            yield (class_name, 'irc', None, None, target, 'text/irc', 1,
+                   'always')
+        # Managed subscriptions of the subscribed sessions and channels
+        sids = SubscriptionFilter(self.env).get_subscribers(class_name)
+        if not sids:
+            return
+        for sub in SubscriptionHandler.\
+                find_subscriptions_by_sids(self.env, class_name, sids):
+            record_origin(event, sub[4], class_name)
+            yield sub
+
+    def description(self):
+        return _("Notify about changesets added to the repositories")
+
+    def requires_authentication(self):
+        return False
+
+    def default_subscriptions(self):
+        class_name = self.__class__.__name__
+        return NotificationSystem(self.env).default_subscriptions(class_name)
+
+    # ISubscriptionInfoProvider methods
+    def get_subscription_info(self):
+        return self.__class__.__name__, self.description(), True
 
 
 class CustomQueryIrcSubscriber(Component):
@@ -150,7 +243,8 @@ class CustomQueryIrcSubscriber(Component):
             - targets: recepients listed separated by comma
                 (ex. mmolnar, agal, #IT, #lobby)
                 there are special targets marked with '_' prefix
-                such as _reporter, _owner, _involved
+                such as _reporter, _owner, _involved, and _group:<name>
+                for the members of a permission group
                 Example: <query_name>.targets = <target1>, <target2>, _owner
             - conditions: notification is only sent if all the listed
                 conditions are fullfilled. Available condition properties:
@@ -159,6 +253,9 @@ class CustomQueryIrcSubscriber(Component):
                 check property changes rather that states.
                 Conditions should be listed in the following way:
                 <query_name>.conditions = <[_]property>:<value>;...
+        Optionally, the delivery priority of the notifications can be set,
+        lower numbers are sent first:
+                <query_name>.priority = <number>
         Here is an exapmle how the custom query can be configured in the
         Trac.ini:
         {{{
@@ -169,8 +266,6 @@ class CustomQueryIrcSubscriber(Component):
         }}}
         """)
 
-    group_providers = ExtensionPoint(IPermissionGroupProvider)
-
     # Innec class
     class ConfigurableSubscriber:
 
@@ -178,12 +273,15 @@ class CustomQueryIrcSubscriber(Component):
         _conditions = ['status', 'type', 'resolution', 'owner', 'reporter',
                        'involved']
 
-        def __init__(self, id, desc, targets, conditions, outer_subscriber):
+        def __init__(self, id, desc, targets, conditions, outer_subscriber,
+                     priority=None):
             self.id = id
             self.desc = desc
+            self.priority = priority
             self.targets = [x.strip() for x in targets.split(',')]
+            self.special_targets = [x for x in self.targets
+                                    if x.startswith('_')]
             self.conditions = self.process_conditions(conditions)
-            self.group_providers = outer_subscriber.group_providers
             self.env = outer_subscriber.env
             self.log = outer_subscriber.log
 
@@ -202,8 +300,8 @@ class CustomQueryIrcSubscriber(Component):
             for target in self.targets:
                 if target.startswith('_'):
                     for spec_target in self.\
-                         _handle_special_targets(target, ticket):
-                        if spec_target is not None:
+                         _handle_special_targets(target, ticket, changes):
+                        if spec_target:
                             yield spec_target
                 else:
                     yield target
@@ -211,12 +309,63 @@ class CustomQueryIrcSubscriber(Component):
         def is_applicable(self, ticket, changes):
             return self._check_conditions(ticket, changes)
 
+        def get_indexed_condition(self):
+            """Return a `([_]prop, value)` condition of the query which
+            can be checked with a lookup of the ticket field, or of its new
+            value in the changes, or `None`. Conditions on changes are
+            preferred, since they are rarely fulfilled."""
+            indexed = None
+            for rawprop, req in sorted(self.conditions.iteritems()):
+                prop = rawprop.lstrip('_')
+                if prop not in self._conditions or rawprop == 'involved':
+                    continue
+                if rawprop != prop:
+                    return rawprop, req
+                if indexed is None:
+                    indexed = rawprop, req
+            return indexed
+
+        def get_dependencies(self):
+            """Return the ticket fields and the changed ticket fields the
+            conditions and the targets of the query depend on, and whether
+            they depend on the previous owners of the ticket and on the
+            permission groups."""
+            fields, changed, history = set(), set(), False
+            involved = groups = False
+            for rawprop in self.conditions:
+                prop = rawprop.lstrip('_')
+                if prop not in self._conditions:
+                    continue
+                if rawprop != prop:
+                    changed.add(prop)
+                elif prop == 'involved':
+                    involved = True
+                else:
+                    fields.add(prop)
+            for target in self.targets:
+                if target == '_owner':
+                    fields.add('owner')
+                    changed.add('owner')
+                elif target == '_reporter':
+                    fields.add('reporter')
+                elif target == '_involved':
+                    involved = True
+                elif target.startswith('_group:'):
+                    groups = True
+            if involved:
+                fields.update(('owner', 'reporter', 'cc'))
+                changed.add('owner')
+                history = groups = True
+            return fields, changed, history, groups
+
         def _handle_special_targets(self, target, ticket, changes):
+            # _group takes the name of the group: _group:<name>
+            target, sep, name = target.partition(':')
             if target not in self._special_targets:
-                return None
+                return []
             if target == '_owner':
                 owner_list = [ticket['owner'], ]
-                if 'owner' in changes['fields']:
+                if 'owner' in changes.get('fields', {}):
                     owner_list.append(changes['fields']['owner']['new'])
                 return owner_list
             if target == '_reporter':
@@ -224,21 +373,30 @@ class CustomQueryIrcSubscriber(Component):
             if target == '_involved':
                 return self._get_related_users(ticket, changes)
             if target == '_group':
-                # TODO
-                pass
+                return sorted(PermissionGroupIndex(self.env).
+                              get_members(name.strip()))
+            return []
 
         def _get_related_users(self, ticket, changes):
             related_users = [ticket['owner'], ticket['reporter']]
             related_users += \
                 [x.strip() for x in (ticket['cc'] or '').split(',')]
-            if 'owner' in changes['fields']:
+            if 'owner' in changes.get('fields', {}):
                 related_users.append(changes['fields']['owner']['new'])
-            for previous_owner in self.env.db_query("""
+            related_users += self._get_previous_owners(ticket)
+            return related_users
+
+        def _get_previous_owners(self, ticket):
+            # read once per change of the ticket, for all the custom queries
+            cached = ticket.__dict__.get('_irc_previous_owners')
+            if cached is not None and cached[0] == ticket['changetime']:
+                return cached[1]
+            owners = [owner for owner, in self.env.db_query("""
                     SELECT DISTINCT oldvalue FROM ticket_change
                     WHERE ticket=%s AND field='owner'
-                    """, (ticket.id, )):
-                related_users.append(previous_owner[0])
-            return related_users
+                    """, (ticket.id, ))]
+            ticket._irc_previous_owners = (ticket['changetime'], owners)
+            return owners
 
         def _check_conditions(self, ticket, changes):
             passed_check = True
@@ -263,54 +421,104 @@ class CustomQueryIrcSubscriber(Component):
             return changes['fields'][prop]['new'] == req
 
         def _check_involved(self, ticket, changes, req):
-            # TODO cache groups
             related_users = set(self._get_related_users(ticket, changes))
             if req in related_users:
                 return True
-            for sid in related_users:
-                groups = self._get_groups_for_user(sid)
-                groups = [x for x in groups if
-                          x not in ['somebody', 'anonymous', '']]
-                self.log.debug('#_check_involved: user: %s, groups: %s'
-                               % (sid, ', '.join(groups)))
-                if req in groups:
-                    return True
-            return False
-
-        def _get_groups_for_user(self, sid):
-            subjects = set()
-            for provider in self.group_providers:
-                subjects.update(provider.get_permission_groups(sid) or [])
-            return subjects
-
-    def __init__(self):
-        # init list of custom queries
-        self.custom_queries = self._get_custom_queries()
+            members = PermissionGroupIndex(self.env).get_members(req)
+            return not related_users.isdisjoint(members)
+
+    @lazy
+    def custom_queries(self):
+        # the config section is only parsed when the first event arrives
+        return self._get_custom_queries()
+
+    @lazy
+    def _queries_by_condition(self):
+        # the queries by one of their conditions, and the ones without an
+        # indexable condition
+        indexed = defaultdict(list)
+        unindexed = []
+        for query in self.custom_queries:
+            condition = query.get_indexed_condition()
+            if condition is None:
+                unindexed.append(query)
+            else:
+                indexed[condition].append(query)
+        fields = set(rawprop for rawprop, req in indexed
+                     if not rawprop.startswith('_'))
+        return indexed, sorted(fields), unindexed
+
+    def _get_candidate_queries(self, event):
+        """Return the custom queries whose indexed condition is fulfilled
+        by the event, and the ones without indexed condition."""
+        indexed, fields, unindexed = self._queries_by_condition
+        if not indexed:
+            return unindexed
+        ticket = event.target
+        queries = list(unindexed)
+        for field in fields:
+            queries.extend(indexed.get((field, ticket[field]), ()))
+        changes = (event.changes or {}).get('fields', {})
+        for field, change in changes.iteritems():
+            queries.extend(indexed.get(('_' + field, change.get('new')), ()))
+        return queries
+
+    @lazy
+    def _dependencies(self):
+        fields, changed, history, groups = set(), set(), False, False
+        for query in self.custom_queries:
+            query_fields, query_changed, query_history, query_groups = \
+                query.get_dependencies()
+            fields.update(query_fields)
+            changed.update(query_changed)
+            history |= query_history
+            groups |= query_groups
+        return sorted(fields), sorted(changed), history, groups
 
     # INotificationSubscriber methods
+    @traced
     def matches(self, event):
+        if event.realm != 'ticket' or not SubscriptionFilter(self.env).\
+                get_subscribers(self.__class__.__name__):
+            return
+        # the key is computed while traced, it may read the ticket history
+        fields, changed, history, groups = self._dependencies
+        key = event_key(event, fields, changed)
+        if history and self.custom_queries:
+            key += tuple(sorted(self.custom_queries[0].
+                                _get_previous_owners(event.target)))
+        if groups:
+            key += (PermissionGroupIndex(self.env).get_version(),)
+        for sub in cached_matches(self, event, self._match, key):
+            yield sub
+
+    def _match(self, event):
         class_name = self.__class__.__name__
-        format = 'text/irc'
-        priority = 0
-        href = Href('')
-        resource_id = ''
-        if event.realm == 'ticket':
-            resource = event.target.resource()
-            resource_id = href(resource.realm, resource.id)
-        else:
+        if event.realm != 'ticket':
             return
-        # Managed subscriptions
-        for query in self.custom_queries:
+        subscribers = SubscriptionFilter(self.env).\
+            get_subscribers(class_name)
+        if not subscribers:
+            return
+        queries_by_target = defaultdict(list)
+        for query in self._get_candidate_queries(event):
+            if not query.special_targets and \
+                    subscribers.isdisjoint(query.targets):
+                continue
             if not query.is_applicable(event.target, event.changes):
                 continue
-            targets = query.yield_targets(event.target, event.changes)
-            for s in Subscription.find_by_class(self.env, class_name):
-                sub = list(s.subscription_tuple())
-                if sub[2] not in targets:
-                    continue
-                sub[4] = sub[2]
-                sub = tuple(sub)
-                yield sub
+            for target in query.yield_targets(event.target, event.changes):
+                if target in subscribers:
+                    queries_by_target[target].append(query)
+        if not queries_by_target:
+            return
+        # Managed subscriptions of the targets, in a single query
+        for sub in SubscriptionHandler.\
+                find_subscriptions_by_sids(self.env, class_name,
+                                           queries_by_target):
+            for query in queries_by_target[sub[2]]:
+                record_origin(event, sub[4], class_name, query.priority)
+            yield sub
 
     def description(self):
         return _("Notify about ticket changes based on custom queries")
@@ -324,10 +532,7 @@ class CustomQueryIrcSubscriber(Component):
 
     # ISubscriptionInfoProvider methods
     def get_subscription_info(self):
-        class_name = self.__class__.__name__
-        subscriptions = Subscription.find_by_class(self.env, class_name)
-        return self.__class__.__name__, self.description(), True, \
-            [(s['sid'], s['id']) for s in subscriptions]
+        return self.__class__.__name__, self.description(), True
 
     # private methods
     def _get_custom_queries(self):
@@ -335,7 +540,9 @@ class CustomQueryIrcSubscriber(Component):
             'targets': '_owner',
             'conditions': 'always',
         }
-        optional_attrs = {}
+        optional_attrs = {
+            'priority': 0,
+        }
         known_attrs = required_attrs.copy()
         known_attrs.update(optional_attrs)
 
@@ -364,9 +571,11 @@ class CustomQueryIrcSubscriber(Component):
             targets = attributes['targets']
             conditions = attributes['conditions']
             desc = attributes['desc']
+            priority = attributes.get('priority')
             custom_queries.append(CustomQueryIrcSubscriber.
                                   ConfigurableSubscriber(name, desc, targets,
-                                                         conditions, self))
+                                                         conditions, self,
+                                                         priority))
         return custom_queries
 
 
@@ -382,99 +591,376 @@ class SubscriptionHandler(Component):
         rule['format'] = 'text/irc'
         rule['adverb'] = 'always'
         rule['class'] = name
-        Subscription.add(env, rule)
+        with env.db_transaction:
+            Subscription.add(env, rule)
+            RecipientCache(env).invalidate()
         logger.debug('Subscriber added to %s: %s' % (name, sub))
 
     @classmethod
-    def update_subscriptions(cls, env, logger, sid, updated_subscriptions,
-                             insert):
-        remove_subscriptions = len(updated_subscriptions) == 0
+    def add_resource_subscriptions(cls, env, logger, sid, resource_ids):
+        """Subscribe the session to the changes of the resources, given as
+        paths like `/ticket/1` or `/wiki/WikiStart`."""
+        class_name = 'ResourceChangeIrcSubscriber'
         with env.db_transaction as db:
-            cursor = db.cursor()
-            if remove_subscriptions:
-                cursor.execute("""DELETE FROM session_attribute
-                      WHERE sid=%s AND authenticated=1 and name='subscriptions'
-                      """, (self.sid))
-                logger.debug('Subscriptions were removed for %s.' % sid)
-            elif insert:
-                cursor.execute("""INSERT INTO session_attribute VALUES
-                               (%s,%s,'subscriptions',%s)""",
-                               (sid, 1, updated_subscriptions)
-                               )
-                logger.debug(
-                    'Subscriptions were inserted into '
-                    'session_attribute table for %s.' % sid)
-            else:
-                cursor.execute("""UPDATE session_attribute SET value=%s
-                      WHERE sid=%s and authenticated=1 and name='subscriptions'
-                      """, (updated_subscriptions, sid)
-                      )
-                logger.debug('Subscriptions were updated for %s.' % sid)
-        env.invalidate_known_users_cache()
+            existing = set(db("""
+                SELECT realm, target FROM notify_watch
+                WHERE sid=%s AND authenticated=1 AND class=%s
+                """, (sid, class_name)))
+            added = set(cls._split_resource_id(resource_id)
+                        for resource_id in resource_ids) - existing
+            db.executemany("""
+                INSERT INTO notify_watch (sid, authenticated, class, realm,
+                                          target)
+                VALUES (%s, 1, %s, %s, %s)
+                """, [(sid, class_name, realm, target)
+                      for realm, target in sorted(added)])
+            if added:
+                RecipientCache(env).invalidate()
+        logger.debug('Subscriptions were added for %s: %s' %
+                     (sid, ', '.join(resource_ids)))
 
     @classmethod
     def get_session_subscriptions(cls, env, sid):
-        with env.db_query as db:
-            cursor = db.cursor()
-            cursor.execute("""
-                SELECT value
-                  FROM session_attribute
-                 WHERE sid=%s
-                   AND authenticated=%s
-                   AND name=%s
-            """, (sid, 1, 'subscriptions'))
-            result = cursor.fetchone()
-            if result:
-                return result[0]
-            return ''
+        """Return the paths of the resources the session is subscribed
+        to."""
+        return [cls._resource_id(realm, target) for realm, target
+                in cls.find_session_subscriptions(env, sid)]
+
+    @classmethod
+    def count_session_subscriptions(cls, env, sid):
+        """Return the number of resources the session is subscribed to."""
+        for count, in env.db_query("""
+                SELECT COUNT(*) FROM notify_watch
+                WHERE sid=%s AND authenticated=1 AND class=%s
+                """, (sid, 'ResourceChangeIrcSubscriber')):
+            return count
+        return 0
+
+    @classmethod
+    def find_session_subscriptions(cls, env, sid, limit=None, offset=0):
+        """Return a page of the (realm, id) tuples of the resources the
+        session is subscribed to, the tickets in numerical order first,
+        then the wiki pages by name."""
+        query = """
+            SELECT realm, target FROM notify_watch
+            WHERE sid=%s AND authenticated=1 AND class=%s
+            ORDER BY realm,
+                     CASE WHEN realm='ticket' THEN LENGTH(target) ELSE 0 END,
+                     target
+            """
+        args = [sid, 'ResourceChangeIrcSubscriber']
+        if limit:
+            query += " LIMIT %s OFFSET %s"
+            args += [limit, offset]
+        return [(realm, target) for realm, target in env.db_query(query, args)]
 
     @classmethod
     def is_session_subscribed_to(cls, env, sid, resource_id):
-        with env.db_query as db:
-            cursor = db.cursor()
-            cursor.execute("""
-                SELECT value
-                  FROM session_attribute
-                 WHERE sid=%s
-                   AND authenticated=%s
-                   AND name=%s
-            """, (sid, 1, 'subscriptions'))
-            result = cursor.fetchone()
-            if result:
-                split_res = [x.strip() for x in result[0].split(',')]
-                return resource_id in split_res
-            return False
+        realm, target = cls._split_resource_id(resource_id)
+        for row in env.db_query("""
+                SELECT id FROM notify_watch
+                WHERE sid=%s AND authenticated=1 AND class=%s
+                  AND realm=%s AND target=%s
+                """, (sid, 'ResourceChangeIrcSubscriber', realm, target)):
+            return True
+        return False
+
+    @classmethod
+    def find_resource_subscriptions(cls, env, class_name, realm, target):
+        """Return the subscription tuples of the sessions subscribed to
+        the given resource, with the session id as irc address."""
+        return [(class_, distributor, sid, authenticated, sid, format,
+                 int(priority), adverb)
+                for class_, distributor, sid, authenticated, format,
+                priority, adverb in env.db_query("""
+                    SELECT s.class, s.distributor, s.sid, s.authenticated,
+                           s.format, s.priority, s.adverb
+                      FROM notify_watch AS w
+                     INNER JOIN notify_subscription AS s
+                        ON (s.sid=w.sid AND s.authenticated=w.authenticated
+                            AND s.class=w.class)
+                     WHERE w.class=%s AND w.realm=%s AND w.target=%s
+                    """, (class_name, realm, target))]
+
+    @classmethod
+    def find_subscriptions_by_sids(cls, env, class_name, sids):
+        """Return the subscription tuples of the given class of the
+        authenticated sessions `sids`, with the session id as irc
+        address."""
+        sids = sorted(set(sids))
+        subscriptions = []
+        for i in xrange(0, len(sids), in_chunk_size):
+            chunk = sids[i:i + in_chunk_size]
+            # filtered here by class, so that the (sid, authenticated)
+            # index is used rather than the one of the class
+            subscriptions.extend(
+                (class_, distributor, sid, authenticated, sid, format,
+                 int(priority), adverb)
+                for class_, distributor, sid, authenticated, format,
+                priority, adverb in env.db_query("""
+                    SELECT class, distributor, sid, authenticated, format,
+                           priority, adverb
+                      FROM notify_subscription
+                     WHERE authenticated=1 AND sid IN (%s)
+                    """ % ','.join(['%s'] * len(chunk)), chunk)
+                if class_ == class_name)
+        return subscriptions
 
     @classmethod
     def is_session_subscribed_for_ticket_changes(cls, env, sid):
+        result = Subscription. \
+            find_by_sids_and_class(env, ((sid, 1),),
+                                   'ResourceChangeIrcSubscriber')
+        return len(result) != 0
+
+    @classmethod
+    def count_subscriptions_by_class(cls, env):
+        """Return a dictionary of irc subscription counts per class."""
+        return dict(env.db_query("""
+            SELECT class, COUNT(*)
+              FROM notify_subscription
+             WHERE distributor=%s
+             GROUP BY class
+            """, ('irc',)))
+
+    @classmethod
+    def count_subscriptions(cls, env, class_name, sid_filter=None,
+                            resource_filter=None):
+        """Return the number of irc subscriptions of the given class
+        which match the filters."""
+        with env.db_query as db:
+            query, args = cls._subscriptions_query(db, 'COUNT(*)', class_name,
+                                                   sid_filter,
+                                                   resource_filter)
+            for count, in db(query, args):
+                return count
+        return 0
+
+    @classmethod
+    def find_subscriptions(cls, env, class_name, sid_filter=None,
+                           resource_filter=None, limit=None, offset=0):
+        """Return a page of (sid, id) tuples of the irc subscriptions
+        of the given class ordered by sid.
+
+        :param sid_filter: only sids starting with this prefix are returned
+        :param resource_filter: only sessions subscribed to a resource whose
+                                path contains this text are returned
+        """
         with env.db_query as db:
-            result = Subscription. \
-                find_by_sids_and_class(env, ((sid, 1),),
-                                       'ResourceChangeIrcSubscriber')
-            return len(result) != 0
+            query, args = cls._subscriptions_query(db, 's.sid, s.id',
+                                                   class_name, sid_filter,
+                                                   resource_filter)
+            query += " ORDER BY s.sid"
+            if limit:
+                query += " LIMIT %s OFFSET %s"
+                args += [limit, offset]
+            return [(sid, id) for sid, id in db(query, args)]
+
+    @classmethod
+    def _subscriptions_query(cls, db, columns, class_name, sid_filter,
+                             resource_filter):
+        query = "SELECT %s FROM notify_subscription AS s" % columns
+        conditions = ["s.class=%s", "s.distributor=%s"]
+        args = [class_name, 'irc']
+        if resource_filter:
+            # notify_watch is looked up by its (sid, authenticated, class)
+            # index
+            conditions.append("""EXISTS (
+                SELECT * FROM notify_watch AS w
+                 WHERE w.sid=s.sid AND w.authenticated=s.authenticated
+                   AND w.class=s.class AND %s %s)"""
+                % (db.concat("'/'", 'w.realm', "'/'", 'w.target'),
+                   db.like()))
+            args.append('%%%s%%' % db.like_escape(resource_filter))
+        if sid_filter:
+            conditions.append("s.sid %s" % db.prefix_match())
+            args.append(db.prefix_match_value(sid_filter))
+        query += " WHERE " + " AND ".join(conditions)
+        return query, args
+
+    @classmethod
+    def collect_garbage(cls, env, logger, dry_run=False):
+        """Remove the irc subscriptions which cannot match any more: the
+        duplicated resource subscriptions, and the ones of deleted
+        tickets, wiki pages and sessions.
+
+        Resource subscriptions are only made from the preferences of an
+        authenticated session, so a missing session means it has been
+        deleted. The other `Subscription` rows are kept whatever their
+        sid, as a sid without a session is the nick of the target.
+
+        :return: a dictionary of statistics
+        """
+        class_name = 'ResourceChangeIrcSubscriber'
+        stats = dict.fromkeys(('sessions', 'duplicates', 'dangling',
+                               'rows', 'rows_before', 'rows_after',
+                               'resources_before', 'resources_after'), 0)
+        with env.db_transaction as db:
+            sessions = set(sid for sid, in db("""
+                SELECT sid FROM session WHERE authenticated=1
+                UNION
+                SELECT sid FROM session_attribute WHERE authenticated=1
+                """))
+            watches = defaultdict(list)
+            tickets, pages = set(), set()
+            for id, sid, realm, target in db("""
+                    SELECT id, sid, realm, target FROM notify_watch
+                    WHERE class=%s AND authenticated=1 ORDER BY id
+                    """, (class_name,)):
+                watches[sid].append((id, realm, target))
+                if realm == 'ticket' and target.isdigit():
+                    tickets.add(int(target))
+                elif realm == 'wiki':
+                    pages.add(target)
+            tickets = cls._find_existing(db, 'ticket', 'id', tickets)
+            pages = cls._find_existing(db, 'wiki', 'name', pages)
+
+            removed_watches = []
+            resources = {}
+            for sid, rows in watches.iteritems():
+                # channels have no session
+                has_session = sid.startswith('#') or sid in sessions
+                kept = set()
+                for id, realm, target in rows:
+                    if (realm, target) in kept:
+                        stats['duplicates'] += 1
+                    elif not has_session or not target or \
+                            realm == 'ticket' and \
+                            not (target.isdigit() and
+                                 int(target) in tickets) or \
+                            realm == 'wiki' and target not in pages:
+                        stats['dangling'] += 1
+                    else:
+                        kept.add((realm, target))
+                        continue
+                    removed_watches.append((id,))
+                stats['resources_before'] += len(rows)
+                stats['resources_after'] += len(kept)
+                if len(kept) != len(rows):
+                    stats['sessions'] += 1
+                resources[sid] = kept
+
+            removed = []
+            for id, sid in db("""
+                    SELECT id, sid FROM notify_subscription
+                    WHERE distributor='irc' AND authenticated=1
+                      AND class=%s
+                    """, (class_name,)):
+                stats['rows_before'] += 1
+                if not resources.get(sid):
+                    removed.append((id,))
+                else:
+                    stats['rows_after'] += 1
+            stats['rows'] = len(removed)
+
+            if not dry_run:
+                db.executemany("""
+                    DELETE FROM notify_watch WHERE id=%s
+                    """, removed_watches)
+                db.executemany("""
+                    DELETE FROM notify_subscription WHERE id=%s
+                    """, removed)
+                RecipientCache(env).invalidate()
+        logger.info('Irc subscription garbage collection%s: %d duplicated '
+                    'and %d dangling resource subscriptions of %d sessions, '
+                    '%d subscriptions', ' (dry run)' if dry_run else '',
+                    stats['duplicates'], stats['dangling'],
+                    stats['sessions'], stats['rows'])
+        return stats
+
+    @classmethod
+    def _split_resource_id(cls, resource_id):
+        realm, sep, id = resource_id.strip().lstrip('/').partition('/')
+        return realm, unicode_unquote(id)
+
+    @classmethod
+    def _resource_id(cls, realm, id):
+        return Href('')(realm, id)
+
+    @classmethod
+    def _find_existing(cls, db, table, column, ids):
+        ids = list(ids)
+        existing = set()
+        for i in xrange(0, len(ids), in_chunk_size):
+            chunk = ids[i:i + in_chunk_size]
+            existing.update(id for id, in db("""
+                SELECT DISTINCT %s FROM %s WHERE %s IN (%s)
+                """ % (column, table, column, ','.join(['%s'] * len(chunk))),
+                chunk))
+        return existing
 
     @classmethod
     def remove_all_subscriptions(cls, env, logger, sid):
-        session_subs = SubscriptionHandler.get_session_subscriptions(env, sid)
-        session_subs_is_empty = len(session_subs) == 0
-        if session_subs_is_empty:
-            return
-        SubscriptionHandler.update_subscriptions(env, logger, sid, '',
-                                                 session_subs_is_empty)
+        with env.db_transaction:
+            Watch.delete_by_sid_and_class(env, sid, 1,
+                                          'ResourceChangeIrcSubscriber')
+            RecipientCache(env).invalidate()
+        logger.debug('Subscriptions were removed for %s.' % sid)
 
     @classmethod
     def remove_subscriptions(cls, env, logger, sid, subs_to_remove):
         if len(subs_to_remove) == 0:
             return
-        session_subs = SubscriptionHandler.get_session_subscriptions(env, sid)
-        session_subs_is_empty = len(session_subs) == 0
-        existing_subscriptions = set()
-        if not session_subs_is_empty:
-            existing_subscriptions = \
-                set([x.strip() for x in session_subs.split(',')])
-        removed_subscriptions = set(subs_to_remove)
-        SubscriptionHandler. \
-            update_subscriptions(env, logger, sid,
-                                 ', '.join(list(existing_subscriptions -
-                                                removed_subscriptions)),
-                                 session_subs_is_empty)
\ No newline at end of file
+        targets = defaultdict(set)
+        for resource_id in subs_to_remove:
+            realm, target = cls._split_resource_id(resource_id)
+            targets[realm].add(target)
+        with env.db_transaction as db:
+            for realm, ids in targets.iteritems():
+                ids = sorted(ids)
+                for i in xrange(0, len(ids), in_chunk_size):
+                    chunk = ids[i:i + in_chunk_size]
+                    db("""
+                        DELETE FROM notify_watch
+                        WHERE sid=%%s AND authenticated=1 AND class=%%s
+                          AND realm=%%s AND target IN (%s)
+                        """ % ','.join(['%s'] * len(chunk)),
+                       [sid, 'ResourceChangeIrcSubscriber', realm] + chunk)
+            RecipientCache(env).invalidate()
+        logger.debug('Subscriptions were removed for %s: %s' %
+                     (sid, ', '.join(subs_to_remove)))
+
+
+class IrkerGarbageCollector(Component):
+    """Periodically removes the irc subscriptions which cannot match any
+    more, see `SubscriptionHandler.collect_garbage`."""
+
+    gc_interval = \
+        IntOption('irker', 'gc_interval', 0,
+                  doc="""Number of hours between two automatic garbage
+                  collections of the stale irc subscriptions. The garbage
+                  collection runs in the background thread of the
+                  notification worker. 0 disables it, `trac-admin irker gc`
+                  can still be used.""")
+
+    def __init__(self):
+        self._last_run = None
+        self._lock = threading.Lock()
+
+    def run_if_due(self):
+        """Schedule a garbage collection if the last one is older than
+        `gc_interval` hours."""
+        if self.gc_interval <= 0:
+            return
+        now = time.time()
+        with self._lock:
+            if self._last_run is None:
+                self._last_run = self._get_last_run()
+            if now - self._last_run < self.gc_interval * 3600:
+                return
+            self._last_run = now
+        IrkerNotificationWorker(self.env).enqueue(self._collect, now)
+
+    def _get_last_run(self):
+        for value, in self.env.db_query("""
+                SELECT value FROM system WHERE name='irker_gc_last_run'
+                """):
+            return float(value)
+        return 0
+
+    def _collect(self, now):
+        with self.env.db_transaction as db:
+            db("DELETE FROM system WHERE name='irker_gc_last_run'")
+            db("INSERT INTO system (name, value) VALUES (%s, %s)",
+               ('irker_gc_last_run', str(now)))
+        SubscriptionHandler.collect_garbage(self.env, self.log)
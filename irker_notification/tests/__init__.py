@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Miklos Molnar
+#
+# All rights reserved.
+#
+# This software is licensed as described in the file README.md, which
+# you should have received as part of this distribution.
+
+import unittest
+
+from irker_notification.tests import changesets, delivery, garbage, \
+                                     journal, queries, templates, tracing
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(changesets.test_suite())
+    suite.addTest(delivery.test_suite())
+    suite.addTest(garbage.test_suite())
+    suite.addTest(journal.test_suite())
+    suite.addTest(queries.test_suite())
+    suite.addTest(templates.test_suite())
+    suite.addTest(tracing.test_suite())
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Miklos Molnar
+#
+# All rights reserved.
+#
+# This software is licensed as described in the file README.md, which
+# you should have received as part of this distribution.
+
+import threading
+import unittest
+from datetime import datetime
+
+from trac.util.datefmt import utc
+
+from irker_notification.notification import ChangesetEvent, \
+                                           IrkerChangesetAnnouncer
+from irker_notification.subscription import ChangesetIrcSubscriber, \
+                                           SubscriptionHandler
+from irker_notification.tests.fixtures import EnvironmentTestCase
+from irker_notification.tracing import QueryCounter
+from irker_notification.worker import ChangesetRecord, \
+                                     IrkerNotificationWorker
+
+
+class Repository(object):
+
+    def __init__(self, reponame):
+        self.reponame = reponame
+
+    def display_rev(self, rev):
+        return rev
+
+
+class Changeset(object):
+
+    def __init__(self, rev):
+        self.rev = rev
+        self.author = 'author'
+        self.date = datetime.now(utc)
+        self.message = 'Message of %s' % rev
+
+
+class StatementRecorder(QueryCounter):
+
+    def __init__(self):
+        super(StatementRecorder, self).__init__()
+        self.statements = []
+
+    def record(self, sql):
+        super(StatementRecorder, self).record(sql)
+        self.statements.append(' '.join(sql.split()))
+
+
+class ChangesetIrcSubscriberTestCase(EnvironmentTestCase):
+    """The subscriptions are looked up by the subscribed sessions and
+    channels, the other subscriptions of the class are not read."""
+
+    def setUp(self):
+        EnvironmentTestCase.setUp(self)
+        self.env.config.set('irker', 'changeset_targets', '#commits')
+        for sid in ('#dev', 'alice'):
+            SubscriptionHandler.add_subscription(
+                self.env, self.env.log, sid, 'ChangesetIrcSubscriber')
+        SubscriptionHandler.add_subscription(
+            self.env, self.env.log, 'bob', 'CustomQueryIrcSubscriber')
+        self.event = ChangesetEvent('added', Repository(''),
+                                    datetime.now(utc),
+                                    [ChangesetRecord('1', 'author', None,
+                                                     'Message')])
+
+    def test_matches(self):
+        subscriber = ChangesetIrcSubscriber(self.env)
+        list(subscriber.matches(self.event))
+        with StatementRecorder() as recorder:
+            subscriptions = list(subscriber.matches(self.event))
+        self.assertEqual(['#commits', '#dev', 'alice'],
+                         sorted(sub[4] for sub in subscriptions))
+        self.assertEqual(1, recorder.count)
+        self.assertIn('sid IN (%s,%s)', recorder.statements[0])
+
+
+class IrkerChangesetAnnouncerTestCase(EnvironmentTestCase):
+    """The changesets of a push are announced by a daemon timer, or at
+    exit if the process ends before."""
+
+    def setUp(self):
+        EnvironmentTestCase.setUp(self)
+        self.env.config.set('irker', 'changeset_batch_delay', '60')
+        self.announcer = IrkerChangesetAnnouncer(self.env)
+        self.announced = []
+        self.announcer._notify_changesets = self.announced.append
+
+    def tearDown(self):
+        for thread in threading.enumerate():
+            if isinstance(thread, threading._Timer):
+                thread.cancel()
+        EnvironmentTestCase.tearDown(self)
+
+    def test_flushed_at_exit(self):
+        threads = set(threading.enumerate())
+        for rev in ('1', '2'):
+            self.announcer.changeset_added(Repository('repos'),
+                                           Changeset(rev))
+        timers = set(threading.enumerate()) - threads
+        self.assertEqual(1, len(timers))
+        self.assertTrue(timers.pop().daemon)
+        self.assertEqual([], self.announced)
+
+        self.announcer._flush_all()
+        self.assertEqual([('repos', ['1', '2'])],
+                         [(reponame, [changeset.rev
+                                      for changeset in changesets])
+                          for reponame, changesets in self.announced])
+        # the timer finds nothing left to announce
+        self.announcer._flush('repos')
+        self.assertEqual(1, len(self.announced))
+
+
+class IrkerNotificationWorkerTestCase(EnvironmentTestCase):
+
+    def test_enqueue_after_shutdown(self):
+        self.env.config.set('irker', 'async_notification', 'true')
+        worker = IrkerNotificationWorker(self.env)
+        processed = []
+        worker.enqueue(processed.append, 'queued')
+        worker._shutdown()
+        self.assertEqual(['queued'], processed)
+        worker.enqueue(processed.append, 'at exit')
+        self.assertEqual(['queued', 'at exit'], processed)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(ChangesetIrcSubscriberTestCase))
+    suite.addTest(unittest.makeSuite(IrkerChangesetAnnouncerTestCase))
+    suite.addTest(unittest.makeSuite(IrkerNotificationWorkerTestCase))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
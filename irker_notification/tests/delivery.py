@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Miklos Molnar
+#
+# All rights reserved.
+#
+# This software is licensed as described in the file README.md, which
+# you should have received as part of this distribution.
+
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+from irker_notification.engine import DeliveryEngine
+
+
+class ListLog(object):
+
+    def __init__(self):
+        self.messages = []
+
+    def __getattr__(self, level):
+        return lambda message, *args: \
+            self.messages.append((level, message % args))
+
+
+class RelayFallbackTestCase(unittest.TestCase):
+    """While the relay socket cannot be reached, the messages are sent to
+    irkerd directly, and the state changes are logged once."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'relay.sock')
+        self.irkerd = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.irkerd.bind(('127.0.0.1', 0))
+        self.irkerd.listen(5)
+        self.log = ListLog()
+
+    def tearDown(self):
+        self.irkerd.close()
+        shutil.rmtree(self.dir)
+
+    def _engine(self, fallback=True):
+        irkerd = ('tcp',) + self.irkerd.getsockname()
+        engine = DeliveryEngine(('unix', self.path),
+                                irkerd if fallback else None, 1.0, 1.0)
+        engine.register('env', log=self.log)
+        return engine
+
+    def _received(self, length):
+        conn, address = self.irkerd.accept()
+        conn.settimeout(5.0)
+        data = ''
+        try:
+            while len(data) < length:
+                chunk = conn.recv(length - len(data))
+                if not chunk:
+                    break
+                data += chunk
+            return data
+        finally:
+            conn.close()
+
+    def test_fallback_to_irkerd(self):
+        engine = self._engine()
+        self.assertTrue(engine.send('env', 'first\n'))
+        self.assertTrue(engine.send('env', 'second\n'))
+        self.assertEqual('first\nsecond\n', self._received(13))
+        self.assertEqual(['warning'],
+                         [level for level, message in self.log.messages])
+        self.assertIn(self.path, self.log.messages[0][1])
+        self.assertEqual(2, engine.stats('env')['sent'])
+
+    def test_relay_is_back(self):
+        engine = self._engine()
+        engine.send('env', 'first\n')
+        relay = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        relay.bind(self.path)
+        relay.listen(5)
+        try:
+            engine._retry_relay_at = 0
+            self.assertTrue(engine.send('env', 'second\n'))
+            conn, address = relay.accept()
+            self.assertEqual('second\n', conn.recv(7))
+            conn.close()
+        finally:
+            relay.close()
+        self.assertEqual(['warning', 'info'],
+                         [level for level, message in self.log.messages])
+
+    def test_without_fallback(self):
+        engine = self._engine(fallback=False)
+        self.assertRaises(socket.error, engine.send, 'env', 'first\n')
+        self.assertRaises(socket.error, engine.send, 'env', 'second\n')
+        self.assertEqual(['error'],
+                         [level for level, message in self.log.messages])
+        self.assertIn('relay_fallback', self.log.messages[0][1])
+        self.assertEqual(2, engine.stats('env')['failed'])
+
+
+class ConnectFailureTestCase(unittest.TestCase):
+    """A failed connect is not retried and counts toward the circuit
+    breaker, only a connection closed by the other end is reopened."""
+
+    def setUp(self):
+        # a port nothing listens on
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        self.endpoint = ('tcp',) + sock.getsockname()
+        sock.close()
+        self.engine = DeliveryEngine(self.endpoint, None, 1.0, 1.0)
+        self.engine.register('env', breaker_threshold=2)
+        self.connects = 0
+        connect = self.engine.connection.connect
+
+        def counting_connect():
+            self.connects += 1
+            return connect()
+        self.engine.connection.connect = counting_connect
+
+    def test_connect_is_not_retried(self):
+        self.assertRaises(socket.error, self.engine.send, 'env', 'first\n')
+        self.assertEqual(1, self.connects)
+        self.assertEqual(1, self.engine.stats('env')['failed'])
+
+    def test_breaker_opens_after_connect_failures(self):
+        for line in ('first\n', 'second\n'):
+            self.assertRaises(socket.error, self.engine.send, 'env', line)
+        self.assertFalse(self.engine.send('env', 'third\n'))
+        self.assertEqual(2, self.connects)
+        self.assertEqual(1, self.engine.stats('env')['rejected'])
+
+    def test_closed_connection_is_reopened(self):
+        irkerd = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        irkerd.bind(self.endpoint[1:])
+        irkerd.listen(5)
+        try:
+            broken = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            broken.close()
+            self.engine.connection.sock = broken
+            self.assertTrue(self.engine.send('env', 'first\n'))
+            self.assertEqual(1, self.connects)
+            conn, address = irkerd.accept()
+            conn.settimeout(5.0)
+            self.assertEqual('first\n', conn.recv(6))
+            conn.close()
+        finally:
+            irkerd.close()
+
+
+class SharedEngineTestCase(unittest.TestCase):
+    """A thread connecting to irkerd does not block the deliveries of the
+    other environments of the engine."""
+
+    def setUp(self):
+        self.irkerd = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.irkerd.bind(('127.0.0.1', 0))
+        self.irkerd.listen(5)
+        self.engine = DeliveryEngine(('tcp',) + self.irkerd.getsockname(),
+                                     None, 1.0, 1.0)
+        for key in ('slow', 'fast'):
+            self.engine.register(key)
+
+    def tearDown(self):
+        self.irkerd.close()
+
+    def test_slow_connect(self):
+        connecting = threading.Event()
+        release = threading.Event()
+        connect = self.engine.connection.connect
+
+        def slow_connect():
+            if not connecting.is_set():
+                connecting.set()
+                release.wait(2.0)
+            return connect()
+        self.engine.connection.connect = slow_connect
+        slow = threading.Thread(target=self.engine.send,
+                                args=('slow', 'slow\n'))
+        slow.start()
+        try:
+            connecting.wait(5.0)
+            self.assertTrue(self.engine.send('fast', 'fast\n'))
+            self.assertTrue(slow.is_alive())
+        finally:
+            release.set()
+            slow.join()
+        self.assertEqual(1, self.engine.stats('slow')['sent'])
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(RelayFallbackTestCase))
+    suite.addTest(unittest.makeSuite(ConnectFailureTestCase))
+    suite.addTest(unittest.makeSuite(SharedEngineTestCase))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Miklos Molnar
+#
+# All rights reserved.
+#
+# This software is licensed as described in the file README.md, which
+# you should have received as part of this distribution.
+
+import unittest
+
+from trac.test import EnvironmentStub
+from trac.ticket.model import Ticket
+from trac.ticket.notification import TicketChangeEvent
+
+# the components are registered by the trac.plugins entry points, which
+# are not loaded by the environment stub
+import irker_notification.admin
+import irker_notification.distribution
+import irker_notification.groups
+import irker_notification.journal
+import irker_notification.notification
+import irker_notification.recipients
+import irker_notification.subscription
+import irker_notification.tracing
+import irker_notification.web_ui
+import irker_notification.worker
+
+
+class EnvironmentTestCase(unittest.TestCase):
+    """Runs each test in an in-memory environment with the plugin
+    enabled and synchronous notifications."""
+
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True,
+                                   enable=['trac.*', 'irker_notification.*'])
+        self.env.config.set('irker', 'async_notification', 'false')
+
+    def tearDown(self):
+        self.env.reset_db()
+
+    def create_ticket(self, **values):
+        ticket = Ticket(self.env)
+        ticket['summary'] = 'Summary'
+        ticket['reporter'] = 'reporter'
+        ticket['owner'] = 'owner'
+        ticket.populate(values)
+        ticket.insert()
+        return ticket
+
+    def ticket_event(self, ticket, comment='Comment', changes=None):
+        return TicketChangeEvent('changed', ticket, None, 'author', comment,
+                                 changes or {'fields': {}})
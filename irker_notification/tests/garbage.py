@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Miklos Molnar
+#
+# All rights reserved.
+#
+# This software is licensed as described in the file README.md, which
+# you should have received as part of this distribution.
+
+import unittest
+
+from irker_notification.distribution import IrcDistributor
+from irker_notification.subscription import SubscriptionHandler
+from irker_notification.tests.fixtures import EnvironmentTestCase
+
+
+class CollectGarbageTestCase(EnvironmentTestCase):
+    """Only the resource subscriptions of deleted resources and sessions
+    are collected, a sid without a session may be the nick of a target."""
+
+    def setUp(self):
+        EnvironmentTestCase.setUp(self)
+        self.ticket = self.create_ticket()
+        with self.env.db_transaction as db:
+            db("""
+                INSERT INTO session (sid, authenticated, last_visit)
+                VALUES ('alice', 1, 0)
+                """)
+        for sid in ('alice', 'deleted'):
+            SubscriptionHandler.add_subscription(
+                self.env, self.env.log, sid, 'ResourceChangeIrcSubscriber')
+            SubscriptionHandler.add_resource_subscriptions(
+                self.env, self.env.log, sid,
+                ['/ticket/%d' % self.ticket.id, '/ticket/999'])
+        for sid in ('somenick', '#channel', 'alice'):
+            SubscriptionHandler.add_subscription(
+                self.env, self.env.log, sid, 'ChangesetIrcSubscriber')
+
+    def _subscriptions(self):
+        return sorted(self.env.db_query("""
+            SELECT sid, class FROM notify_subscription
+            WHERE distributor='irc'
+            """))
+
+    def test_collect_garbage(self):
+        stats = SubscriptionHandler.collect_garbage(self.env, self.env.log)
+        self.assertEqual(3, stats['dangling'])
+        self.assertEqual(1, stats['rows'])
+        self.assertEqual([('#channel', 'ChangesetIrcSubscriber'),
+                          ('alice', 'ChangesetIrcSubscriber'),
+                          ('alice', 'ResourceChangeIrcSubscriber'),
+                          ('somenick', 'ChangesetIrcSubscriber')],
+                         self._subscriptions())
+        self.assertEqual(['/ticket/%d' % self.ticket.id],
+                         SubscriptionHandler.
+                         get_session_subscriptions(self.env, 'alice'))
+        self.assertEqual([], SubscriptionHandler.
+                         get_session_subscriptions(self.env, 'deleted'))
+
+    def test_dry_run(self):
+        before = self._subscriptions()
+        stats = SubscriptionHandler.collect_garbage(self.env, self.env.log,
+                                                    dry_run=True)
+        self.assertEqual(1, stats['rows'])
+        self.assertEqual(before, self._subscriptions())
+
+    def _gc_last_run(self):
+        return self.env.db_query("""
+            SELECT value FROM system WHERE name='irker_gc_last_run'
+            """)
+
+    def test_periodic_collection(self):
+        self.env.config.set('irker', 'gc_interval', '1')
+        before = self._subscriptions()
+        distributor = IrcDistributor(self.env)
+        with distributor.dry_run():
+            distributor.distribute('irc', [], self.ticket_event(self.ticket))
+        self.assertEqual(before, self._subscriptions())
+        self.assertEqual([], self._gc_last_run())
+        distributor.distribute('irc', [], self.ticket_event(self.ticket))
+        self.assertNotEqual(before, self._subscriptions())
+        self.assertEqual(1, len(self._gc_last_run()))
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(CollectGarbageTestCase))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
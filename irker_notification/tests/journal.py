@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Miklos Molnar
+#
+# All rights reserved.
+#
+# This software is licensed as described in the file README.md, which
+# you should have received as part of this distribution.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import irker_notification.journal
+from irker_notification.journal import DeliveryJournal
+from irker_notification.tests.fixtures import EnvironmentTestCase
+
+
+class DeliveryJournalTestCase(EnvironmentTestCase):
+    """The attempts are looked up by resource and target through the
+    hashed index, also in the rotated journals."""
+
+    def setUp(self):
+        EnvironmentTestCase.setUp(self)
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'journal.log')
+        self.env.config.set('irker', 'journal_file', self.path)
+        self.env.config.set('irker', 'journal_max_bytes', '0')
+        self.env.config.set('irker', 'journal_backup_count', '2')
+        self.journal = DeliveryJournal(self.env)
+        self.tickets = [self.create_ticket() for i in xrange(3)]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        EnvironmentTestCase.tearDown(self)
+
+    def _record(self, ticket, target, status='sent'):
+        self.journal.record(self.ticket_event(ticket), target, status, 0.01)
+
+    def _find(self, ticket, limit=20):
+        return [(entry['id'], entry['target'], entry['status'])
+                for entry in self.journal.find_by_resource(
+                    'ticket', ticket.id, limit)]
+
+    def test_find_by_resource(self):
+        first, second = self.tickets[:2]
+        self._record(first, 'alice')
+        self._record(second, 'bob')
+        self._record(first, '#dev', 'failed')
+        self.journal.flush()
+        id = unicode(first.id)
+        self.assertEqual([(id, '#dev', 'failed'), (id, 'alice', 'sent')],
+                         self._find(first))
+        self.assertEqual([(id, '#dev', 'failed')], self._find(first, 1))
+        self.assertEqual([], self.journal.find_by_resource('ticket', 99))
+
+    def test_find_by_target(self):
+        for ticket in self.tickets:
+            self._record(ticket, '#dev')
+        self._record(self.tickets[0], 'alice')
+        self.journal.flush()
+        self.assertEqual([unicode(ticket.id)
+                          for ticket in reversed(self.tickets)],
+                         [entry['id'] for entry
+                          in self.journal.find_by_target('#dev')])
+
+    def test_lookup_reads_one_bucket(self):
+        for i in xrange(50):
+            self._record(self.tickets[0], 'nick%d' % i)
+        self.journal.flush()
+        buckets = os.listdir(self.path + '.index')
+        self.assertLess(1, len(buckets))
+        opened = []
+
+        def tracking_open(name, *args):
+            opened.append(name)
+            return open(name, *args)
+        irker_notification.journal.open = tracking_open
+        try:
+            self.assertEqual(1, len(self.journal.find_by_target('nick7')))
+        finally:
+            del irker_notification.journal.open
+        # the bucket of the key in each journal, and the current journal
+        self.assertEqual([self.journal._bucket(segment, 'target:nick7')
+                          for segment in self.journal._segments(self.path)],
+                         [name for name in opened if '.index' in name])
+        self.assertEqual([self.path],
+                         [name for name in opened
+                          if name.endswith('journal.log')])
+
+    def test_rotation(self):
+        self.env.config.set('irker', 'journal_max_bytes', '1')
+        first, second, third = self.tickets
+        for ticket in self.tickets:
+            # each batch fills a journal, which is then rotated
+            self._record(ticket, 'alice')
+            self.journal.flush()
+        self.assertFalse(os.path.exists(self.path))
+        for segment in (self.path + '.1', self.path + '.2'):
+            self.assertTrue(os.path.isfile(segment))
+            self.assertTrue(os.path.isdir(segment + '.index'))
+        self.assertFalse(os.path.exists(self.path + '.3'))
+        # the journal of the first ticket was dropped by the rotation
+        self.assertEqual([], self._find(first))
+        self.assertEqual([(unicode(third.id), 'alice', 'sent')],
+                         self._find(third))
+        self.assertEqual([unicode(third.id), unicode(second.id)],
+                         [entry['id'] for entry
+                          in self.journal.find_by_target('alice')])
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(DeliveryJournalTestCase))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
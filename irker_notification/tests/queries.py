@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Miklos Molnar
+#
+# All rights reserved.
+#
+# This software is licensed as described in the file README.md, which
+# you should have received as part of this distribution.
+
+import unittest
+
+from irker_notification.benchmark import check_queries, count_queries, \
+                                         in_chunks
+from irker_notification.distribution import SessionIrcResolver
+from irker_notification.subscription import SubscriptionHandler, \
+                                           in_chunk_size
+from irker_notification.tests.fixtures import EnvironmentTestCase
+from irker_notification.tracing import QueryCounter
+
+
+class QueryCountTestCase(unittest.TestCase):
+    """Queries of the plugin for a ticket change, by origin, as the
+    number of recipients of each subscriber grows."""
+
+    # the recipients fit in one IN list, and the larger size takes two
+    sizes = (10, 100)
+    large = 1000
+
+    # queries of an event per origin, whatever the number of recipients
+    budget = {
+        'subscriber.TicketReporterAndOwnerSubscriber': 2,
+        'subscriber.ResourceChangeIrcSubscriber': 1,
+        'subscriber.CustomQueryIrcSubscriber': 1,
+        'subscriber.ChangesetIrcSubscriber': 0,
+        'resolver.SessionIrcResolver': 1,
+        'formatter.ShortIrcNotificationFormatter': 0,
+        'distributor.IrcDistributor': 0,
+        'sender': 0,
+    }
+    max_queries = 10
+
+    @classmethod
+    def setUpClass(cls):
+        cls.results = dict((size, count_queries(size))
+                           for size in cls.sizes + (cls.large,))
+
+    def _origin(self, size, name):
+        return self.results[size][0].get(name, 0)
+
+    def _assert_origin(self, name):
+        counts = [self._origin(size, name) for size in self.sizes]
+        self.assertEqual([counts[0]] * len(counts), counts,
+                         "%s: %r queries for %r recipients" %
+                         (name, counts, self.sizes))
+        self.assertLessEqual(counts[0], self.budget[name])
+
+    def test_ticket_reporter_and_owner_subscriber(self):
+        self._assert_origin('subscriber.TicketReporterAndOwnerSubscriber')
+
+    def test_resource_change_subscriber(self):
+        self._assert_origin('subscriber.ResourceChangeIrcSubscriber')
+
+    def test_custom_query_subscriber(self):
+        self._assert_origin('subscriber.CustomQueryIrcSubscriber')
+
+    def test_changeset_subscriber(self):
+        self._assert_origin('subscriber.ChangesetIrcSubscriber')
+
+    def test_resolver(self):
+        self._assert_origin('resolver.SessionIrcResolver')
+
+    def test_formatter(self):
+        self._assert_origin('formatter.ShortIrcNotificationFormatter')
+
+    def test_distributor_and_sender(self):
+        self._assert_origin('distributor.IrcDistributor')
+        self._assert_origin('sender')
+
+    def test_pipeline(self):
+        totals = [self.results[size][1] for size in self.sizes]
+        self.assertEqual([totals[0]] * len(totals), totals)
+        self.assertLessEqual(totals[0], self.max_queries)
+        for size in self.sizes:
+            self.assertEqual(size, self.results[size][2])
+
+    def test_unmatched_event(self):
+        for size in self.sizes:
+            self.assertLessEqual(self.results[size][3], 1)
+
+    def test_large_recipient_lists(self):
+        # one more query per IN list, never a query per recipient
+        sizes = self.sizes[:1] + (self.large,)
+        self.assertEqual([], check_queries(sizes, [self.results[size]
+                                                   for size in sizes],
+                                           self.max_queries))
+        for name, budget in self.budget.iteritems():
+            self.assertLessEqual(self._origin(self.large, name),
+                                 budget * in_chunks(self.large), name)
+        self.assertEqual(self.large, self.results[self.large][2])
+
+
+class ChunkedLookupTestCase(EnvironmentTestCase):
+    """The lookups by session id take one query per IN list of sessions,
+    they never read the whole table."""
+
+    def setUp(self):
+        EnvironmentTestCase.setUp(self)
+        self.sids = ['user%d' % i for i in xrange(in_chunk_size * 2 + 1)]
+        with self.env.db_transaction as db:
+            db.executemany("""
+                INSERT INTO notify_subscription (time, changetime, class,
+                    sid, authenticated, distributor, format, priority,
+                    adverb)
+                VALUES (0, 0, %s, %s, 1, 'irc', 'text/irc', 1, 'always')
+                """, [('CustomQueryIrcSubscriber', sid)
+                      for sid in self.sids] +
+                [('ResourceChangeIrcSubscriber', 'other%d' % i)
+                 for i in xrange(10)])
+            db.executemany("""
+                INSERT INTO session_attribute (sid, authenticated, name,
+                                               value)
+                VALUES (%s, 1, 'irc_nick', %s)
+                """, [(sid, 'nick-' + sid) for sid in self.sids] +
+                [('other', 'nick-other')])
+
+    def test_find_subscriptions_by_sids(self):
+        with QueryCounter() as counter:
+            subscriptions = SubscriptionHandler.find_subscriptions_by_sids(
+                self.env, 'CustomQueryIrcSubscriber', self.sids[1:])
+        self.assertEqual(2, counter.count)
+        self.assertEqual(sorted(self.sids[1:]),
+                         sorted(sub[2] for sub in subscriptions))
+
+    def test_get_targets_for_sessions(self):
+        sessions = [(sid, 1) for sid in self.sids] + [('missing', 1)]
+        with QueryCounter() as counter:
+            targets = SessionIrcResolver(self.env).\
+                get_targets_for_sessions(sessions)
+        self.assertEqual(3, counter.count)
+        self.assertEqual('nick-user0', targets[('user0', 1)])
+        self.assertEqual('missing', targets[('missing', 1)])
+        self.assertEqual(len(sessions), len(targets))
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(QueryCountTestCase))
+    suite.addTest(unittest.makeSuite(ChunkedLookupTestCase))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
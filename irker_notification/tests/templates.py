@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Miklos Molnar
+#
+# All rights reserved.
+#
+# This software is licensed as described in the file README.md, which
+# you should have received as part of this distribution.
+
+import unittest
+
+from irker_notification.notification import ShortIrcNotificationFormatter
+from irker_notification.tests.fixtures import EnvironmentTestCase
+
+
+class MessageTemplatesTestCase(EnvironmentTestCase):
+    """Invalid `[irker-templates]` are replaced by the default template
+    instead of failing every notification."""
+
+    def setUp(self):
+        EnvironmentTestCase.setUp(self)
+        self.ticket = self.create_ticket()
+
+    def _format(self, **templates):
+        for option, value in templates.iteritems():
+            self.env.config.set('irker-templates',
+                                option.replace('__', '.'), value)
+        formatter = ShortIrcNotificationFormatter(self.env)
+        return formatter.format('irc', 'text/irc',
+                                self.ticket_event(self.ticket))
+
+    def assertDefault(self, message):
+        self.assertTrue(message.startswith(
+            u'Ticket #%d | changed by author | Comment: Comment | '
+            % self.ticket.id), message)
+
+    def test_valid_template(self):
+        self.assertEqual(u'Ticket #%d by author' % self.ticket.id,
+                         self._format(ticket=u'Ticket #{id} by {author}'))
+
+    def test_unbalanced_brace(self):
+        self.assertDefault(self._format(ticket=u'Ticket #{id'))
+
+    def test_unknown_field(self):
+        self.assertDefault(self._format(ticket=u'Ticket {number}'))
+
+    def test_invalid_format_specification(self):
+        self.assertDefault(self._format(ticket=u'Ticket {author:d}'))
+
+    def test_invalid_category_uses_realm_template(self):
+        self.assertEqual(u'Ticket by author',
+                         self._format(ticket=u'Ticket by {author}',
+                                      ticket__changed=u'{summary!x}'))
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(MessageTemplatesTestCase))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
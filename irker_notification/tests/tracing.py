@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Miklos Molnar
+#
+# All rights reserved.
+#
+# This software is licensed as described in the file README.md, which
+# you should have received as part of this distribution.
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from irker_notification.distribution import IrcDistributor
+from irker_notification.tests.fixtures import EnvironmentTestCase
+from irker_notification.tracing import IrkerTracer
+
+
+class TraceFinalizationTestCase(EnvironmentTestCase):
+    """A trace is written when the root span of the distribution exits
+    and its deliveries are done, whether or not the event is still
+    referenced."""
+
+    def setUp(self):
+        EnvironmentTestCase.setUp(self)
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'trace.log')
+        self.env.config.set('irker', 'trace_file', self.path)
+        self.env.config.set('irker', 'trace_sample_rate', '1.0')
+        self.tracer = IrkerTracer(self.env)
+        self.event = self.ticket_event(self.create_ticket())
+
+    def tearDown(self):
+        logger = logging.getLogger('irker.trace.%s' % self.env.path)
+        for handler in logger.handlers[:]:
+            handler.close()
+            logger.removeHandler(handler)
+        shutil.rmtree(self.dir)
+        EnvironmentTestCase.tearDown(self)
+
+    def _traces(self):
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_written_when_distributed(self):
+        distributor = IrcDistributor(self.env)
+        with distributor.dry_run() as deliveries:
+            distributor.distribute('irc', [(None, 0, '#dev', 'text/irc')],
+                                   self.event)
+        self.assertEqual(1, len(deliveries))
+        traces = self._traces()
+        self.assertEqual(1, len(traces))
+        root = traces[0]['spans'][-1]
+        self.assertEqual('distributor.IrcDistributor', root['name'])
+        self.assertIn('sender', [span['name']
+                                 for span in root['children']])
+
+    def test_held_until_released(self):
+        with self.tracer.root_span(self.event, 'root'):
+            self.tracer.hold(self.event)
+        self.assertEqual([], self._traces())
+        # a delivery sent by another thread once the root has exited
+        with self.tracer.span(self.event, 'sender'):
+            pass
+        self.tracer.release(self.event)
+        traces = self._traces()
+        self.assertEqual(1, len(traces))
+        self.assertEqual(['root', 'sender'],
+                         [span['name'] for span in traces[0]['spans']])
+
+    def test_distributed_again(self):
+        for name in ('first', 'second'):
+            with self.tracer.root_span(self.event, name):
+                pass
+        self.assertEqual([['first'], ['second']],
+                         [[span['name'] for span in trace['spans']]
+                          for trace in self._traces()])
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TraceFinalizationTestCase))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Miklos Molnar
+#
+# All rights reserved.
+#
+# This software is licensed as described in the file README.md, which
+# you should have received as part of this distribution.
+
+import functools
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+from trac.config import FloatOption, IntOption, Option
+from trac.core import Component
+from trac.db.util import IterableCursor
+from trac.util import lazy
+from trac.util.datefmt import datetime_now, utc
+from trac.web.href import Href
+
+
+# ==================== Query counting ====================
+_local = threading.local()
+_install_lock = threading.Lock()
+_active = 0
+_patched = {}
+
+
+def _counting(method):
+    @functools.wraps(method)
+    def execute(self, sql, *args, **kwargs):
+        for counter in getattr(_local, 'counters', ()):
+            counter.record(sql)
+        return method(self, sql, *args, **kwargs)
+    return execute
+
+
+def _start_counting():
+    """Make the database cursors report their statements to the active
+    `QueryCounter`s of their thread, until `_stop_counting` has been
+    called as many times. Outside of counters, the cursors of Trac are
+    left untouched."""
+    global _active
+    with _install_lock:
+        if not _active:
+            for name in ('execute', 'executemany'):
+                method = IterableCursor.__dict__[name]
+                _patched[name] = (method, _counting(method))
+                setattr(IterableCursor, name, _patched[name][1])
+        _active += 1
+
+
+def _stop_counting():
+    global _active
+    with _install_lock:
+        _active -= 1
+        if not _active:
+            for name, (method, counting) in _patched.iteritems():
+                # unless somebody else has wrapped them in the meantime
+                if IterableCursor.__dict__.get(name) is counting:
+                    setattr(IterableCursor, name, method)
+            _patched.clear()
+
+
+class QueryCounter(object):
+    """Counts the SQL statements executed by the current thread while it
+    is active. Counters can be nested, each one sees every statement."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __enter__(self):
+        _start_counting()
+        _local.__dict__.setdefault('counters', []).append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _local.counters.remove(self)
+        _stop_counting()
+
+    def record(self, sql):
+        self.count += 1
+
+
+# ==================== Tracing ====================
+class _NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def set(self, name, value):
+        pass
+
+_null_span = _NullSpan()
+
+
+class Span(object):
+    """A timed stage of the notification pipeline of an event. A span can
+    be entered several times, e.g. while a generator is consumed, only the
+    time spent inside is accounted."""
+
+    def __init__(self, trace, name, attrs):
+        self.trace = trace
+        self.name = name
+        self.attrs = attrs
+        self.start = self.end = None
+        self.elapsed = 0.0
+        self.children = []
+        self.counter = QueryCounter()
+        stack = getattr(_local, 'spans', None)
+        parent = stack[-1] if stack and stack[-1].trace is trace else None
+        (parent.children if parent else trace.spans).append(self)
+
+    def __enter__(self):
+        _local.__dict__.setdefault('spans', []).append(self)
+        self.counter.__enter__()
+        self._resumed = time.time()
+        if self.start is None:
+            self.start = self._resumed
+        return self
+
+    def __exit__(self, *exc_info):
+        self.end = time.time()
+        self.elapsed += self.end - self._resumed
+        self.counter.__exit__()
+        _local.spans.remove(self)
+        if exc_info and exc_info[0] is not None:
+            self.attrs['error'] = exc_info[0].__name__
+
+    def set(self, name, value):
+        self.attrs[name] = value
+
+    def to_dict(self, origin):
+        span = {'name': self.name,
+                'start': round((self.start or origin) - origin, 6),
+                'duration': round(self.elapsed, 6),
+                'queries': self.counter.count}
+        if self.attrs:
+            span['attrs'] = self.attrs
+        if self.children:
+            span['children'] = [child.to_dict(origin)
+                                for child in self.children]
+        return span
+
+
+class RootSpan(Span):
+    """The span of the distribution of an event. The trace is complete
+    once it has exited and the deliveries it queued have been sent."""
+
+    def __init__(self, tracer, trace, name, attrs):
+        super(RootSpan, self).__init__(trace, name, attrs)
+        self.tracer = tracer
+
+    def __enter__(self):
+        self.tracer._hold(self.trace)
+        return super(RootSpan, self).__enter__()
+
+    def __exit__(self, *exc_info):
+        super(RootSpan, self).__exit__(*exc_info)
+        self.tracer._release(self.trace)
+
+
+class Trace(object):
+    """The span tree of a single event."""
+
+    def __init__(self, event, sampled):
+        self.realm = event.realm
+        self.category = event.category
+        self.resource = self._get_resource_id(event)
+        self.time = datetime_now(utc)
+        self.sampled = sampled
+        self.spans = []
+        # the root span and the deliveries which are not done yet
+        self.pending = 0
+        self.finished = False
+
+    def _get_resource_id(self, event):
+        try:
+            resource = event.target.resource
+        except AttributeError:
+            return None
+        return Href('')(resource.realm, resource.id)
+
+    @property
+    def start(self):
+        return min(span.start for span in self.spans
+                   if span.start is not None)
+
+    @property
+    def duration(self):
+        return max(span.end for span in self.spans
+                   if span.end is not None) - self.start
+
+    def to_dict(self):
+        origin = self.start
+        return {'time': self.time.isoformat(),
+                'realm': self.realm,
+                'category': self.category,
+                'resource': self.resource,
+                'sampled': self.sampled,
+                'duration': round(self.duration, 6),
+                'queries': sum(span.counter.count for span in self.spans),
+                'spans': [span.to_dict(origin) for span in self.spans]}
+
+
+class IrkerTracer(Component):
+    """Records the time and the number of queries spent in the stages of
+    the notification pipeline of an event: subscribers, resolvers,
+    formatters and the delivery to irkerd. The span trees are written as
+    JSON lines into a rotating log file of the environment, as soon as
+    the root span of the distribution and the deliveries it queued are
+    done. The events without irc recipients are not distributed, and
+    their traces are not written."""
+
+    sample_rate = \
+        FloatOption('irker', 'trace_sample_rate', 0.0,
+                    doc="""Ratio of the events whose trace is written to the
+                    trace log, between 0.0 and 1.0.""")
+
+    slow_threshold = \
+        FloatOption('irker', 'trace_slow_threshold', 0.0,
+                    doc="""Events whose notification takes more seconds
+                    than this are always written to the trace log. Tracing
+                    is disabled if both this and `trace_sample_rate`
+                    are 0.""")
+
+    trace_file = \
+        Option('irker', 'trace_file', 'irker-trace.log',
+               doc="""Name of the trace log. Relative paths are resolved
+               against the log directory of the environment.""")
+
+    trace_max_bytes = \
+        IntOption('irker', 'trace_max_bytes', 10 * 1024 * 1024,
+                  doc="Size of the trace log at which it is rotated.")
+
+    trace_backup_count = \
+        IntOption('irker', 'trace_backup_count', 5,
+                  doc="Number of rotated trace logs to keep.")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.sample_rate > 0 or self.slow_threshold > 0
+
+    def span(self, event, name, **attrs):
+        """Return a context manager timing a stage of the notification
+        of `event`."""
+        if not self.enabled:
+            return _null_span
+        return Span(self._get_trace(event), name, attrs)
+
+    def root_span(self, event, name, **attrs):
+        """Return a context manager timing the distribution of `event`.
+        The trace of the event is written when it exits, or once the
+        deliveries held with `hold` have been released."""
+        if not self.enabled:
+            return _null_span
+        return RootSpan(self, self._get_trace(event), name, attrs)
+
+    def hold(self, event):
+        """Delay the writing of the trace of `event` until `release` has
+        been called, e.g. while a delivery of the event is queued."""
+        trace = event.__dict__.get('_irker_trace')
+        if trace is not None:
+            self._hold(trace)
+
+    def release(self, event):
+        trace = event.__dict__.get('_irker_trace')
+        if trace is not None:
+            self._release(trace)
+
+    def trace_iter(self, event, name, iterable):
+        """Time the consumption of `iterable` as a stage of the
+        notification of `event`."""
+        if not self.enabled:
+            return iterable
+        return self._trace_iter(event, name, iterable)
+
+    def _trace_iter(self, event, name, iterable):
+        span = Span(self._get_trace(event), name, {})
+        count = 0
+        iterator = iter(iterable)
+        while True:
+            with span:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    span.set('results', count)
+                    return
+            # time spent by the consumer is not part of the span
+            count += 1
+            yield item
+
+    # helper functions
+    def _get_trace(self, event):
+        trace = event.__dict__.get('_irker_trace')
+        if trace is None or trace.finished:
+            # an event distributed again gets a new trace
+            trace = Trace(event, random.random() < self.sample_rate)
+            event._irker_trace = trace
+        return trace
+
+    def _hold(self, trace):
+        with self._lock:
+            trace.pending += 1
+
+    def _release(self, trace):
+        with self._lock:
+            trace.pending -= 1
+            if trace.pending or trace.finished:
+                return
+            trace.finished = True
+        self._finish(trace)
+
+    def _finish(self, trace):
+        if not any(span.end for span in trace.spans):
+            return
+        slow = 0 < self.slow_threshold <= trace.duration
+        if not (trace.sampled or slow):
+            return
+        record = trace.to_dict()
+        record['slow'] = slow
+        try:
+            self._trace_logger.info(json.dumps(record))
+        except Exception as e:
+            self.log.warning("IrkerTracer failed to write trace: %s", e)
+
+    @lazy
+    def _trace_logger(self):
+        from logging.handlers import RotatingFileHandler
+
+        path = self.trace_file
+        if not os.path.isabs(path):
+            path = os.path.join(self.env.log_dir, path)
+        logger = logging.getLogger('irker.trace.%s' % self.env.path)
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        if not logger.handlers:
+            handler = RotatingFileHandler(path,
+                                          maxBytes=self.trace_max_bytes,
+                                          backupCount=self.trace_backup_count)
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            logger.addHandler(handler)
+        return logger
+
+
+def traced(method):
+    """Trace a `matches(event)` generator method of a subscriber."""
+    @functools.wraps(method)
+    def matches(self, event):
+        name = 'subscriber.%s' % self.__class__.__name__
+        return IrkerTracer(self.env).trace_iter(event, name,
+                                                method(self, event))
+    return matches
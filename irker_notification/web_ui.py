@@ -6,23 +6,47 @@
 #
 # This software is licensed as described in the file README.md, which
 # you should have received as part of this distribution.
-import pdb
 from pkg_resources import resource_filename
 from trac.admin import IAdminPanelProvider
+from trac.config import IntOption
 from trac.core import Component, ExtensionPoint, implements
 from trac.notification.model import Subscription
+from trac.resource import ResourceNotFound
+from trac.util.presentation import Paginator
 from trac.util.translation import _, dgettext
 from trac.prefs.api import IPreferencePanelProvider
-from trac.web.chrome import (Chrome, ITemplateProvider,
-                             add_notice, add_warning, web_context)
-from trac.web.api import IRequestHandler
+from trac.web.chrome import (ITemplateProvider, add_link, add_notice,
+                             add_warning)
 from subscription import ISubscriptionInfoProvider, SubscriptionHandler
 
 
+def _paginate(req, items, pagenum, max_per_page, num_items, page_href):
+    """Return a `Paginator` of a page of `items` queried from the
+    database, with the links of the other pages."""
+    paginator = Paginator(items, pagenum - 1, max_per_page, num_items)
+    if paginator.has_next_page:
+        add_link(req, 'next', page_href(pagenum + 1), _('Next Page'))
+    if paginator.has_previous_page:
+        add_link(req, 'prev', page_href(pagenum - 1), _('Previous Page'))
+    paginator.shown_pages = [
+        {'href': page_href(p), 'class': None, 'string': str(p),
+         'title': _('Page %(num)d', num=p)}
+        for p in paginator.get_shown_pages(21)]
+    paginator.current_page = {'href': None, 'class': 'current',
+                              'string': str(paginator.page + 1),
+                              'title': None}
+    return paginator
+
+
 class IrkerPreferencePanel(Component):
 
     implements(IPreferencePanelProvider)
 
+    items_per_page = IntOption('irker', 'prefs_items_per_page', 50,
+                               doc="""Number of subscriptions listed on a
+                               page of the Irker Settings preference panel.
+                               """)
+
     _form_fields = ('irc_nick',)
 
     # IPreferencePanelProvider methods
@@ -31,29 +55,36 @@ class IrkerPreferencePanel(Component):
         yield 'irker_settings', _("Irker Settings")
 
     def render_preference_panel(self, req, panel):
+        sid = req.session.sid
         if req.method == 'POST':
-            if req.args.get('unsub'):
-                sel = req.args.get('unsub')
-                sel = sel if isinstance(sel, list) else [sel]
-                SubscriptionHandler.remove_subscriptions(self.env, self.log,
-                                                         req.session.sid, sel)
+            if req.args.get('unsub_all'):
+                SubscriptionHandler.remove_all_subscriptions(self.env,
+                                                             self.log, sid)
+                add_notice(req, _("All your subscriptions have been "
+                                  "revoked."))
+            elif req.args.get('unsub'):
+                SubscriptionHandler.\
+                    remove_subscriptions(self.env, self.log, sid,
+                                         req.args.getlist('unsub'))
                 add_notice(req, _("The selected subscriptions have been "
                                   "revoked."))
             self._do_save(req, panel)
-        subscriptions = SubscriptionHandler.\
-            get_session_subscriptions(self.env, req.session.sid)
-        subscriptions = [(x.strip(), x.strip().split('/')[-1])
-                         for x in subscriptions.split(',')]
-        ticket_subscriptions = sorted([(ox, '#%s' % x) for (ox, x) in
-                                      subscriptions if x.isdigit()],
-                                      key=lambda subs: int(subs[1].lstrip('#'))
-                                      )
-        page_subscriptions = sorted([(ox, x) for (ox, x)
-                                    in subscriptions if not x.isdigit()])
-        subscriptions = ticket_subscriptions + page_subscriptions
+
+        max_per_page = max(self.items_per_page, 1)
+        num_items = SubscriptionHandler.count_session_subscriptions(self.env,
+                                                                    sid)
+        # The last page may be gone after removing subscriptions
+        last_page = max((num_items - 1) // max_per_page + 1, 1)
+        pagenum = min(req.args.getint('page', 1, min=1), last_page)
+        resources = SubscriptionHandler.\
+            find_session_subscriptions(self.env, sid, max_per_page,
+                                       (pagenum - 1) * max_per_page)
+        subscriptions = self._describe(req, resources)
+        paginator = _paginate(req, subscriptions, pagenum, max_per_page,
+                              num_items,
+                              lambda p: req.href.prefs(panel, page=p))
         return 'prefs_irker.html', {'subscriptions': subscriptions,
-                                    'context': web_context(req)
-                                    }
+                                    'paginator': paginator}
 
     def _do_save(self, req, panel):
         for field in self._form_fields:
@@ -65,6 +96,41 @@ class IrkerPreferencePanel(Component):
                 del req.session[field]
         add_notice(req, _("Your preferences have been saved."))
 
+    def _describe(self, req, resources):
+        """Return the subscriptions of a page with the summaries of the
+        tickets and the wiki pages which still exist, queried at once for
+        the whole page."""
+        ids = {}
+        for realm, target in resources:
+            ids.setdefault(realm, []).append(target)
+        summaries = {}
+        tickets = [int(id) for id in ids.get('ticket', []) if id.isdigit()]
+        if tickets:
+            summaries.update((('ticket', unicode(id)), summary)
+                             for id, summary in self.env.db_query("""
+                                 SELECT id, summary FROM ticket
+                                 WHERE id IN (%s)
+                                 """ % ','.join(['%s'] * len(tickets)),
+                                 tickets))
+        pages = ids.get('wiki', [])
+        if pages:
+            summaries.update((('wiki', name), name)
+                             for name, in self.env.db_query("""
+                                 SELECT DISTINCT name FROM wiki
+                                 WHERE name IN (%s)
+                                 """ % ','.join(['%s'] * len(pages)),
+                                 pages))
+        subscriptions = []
+        for realm, target in resources:
+            summary = summaries.get((realm, target))
+            subscriptions.append({
+                'id': SubscriptionHandler._resource_id(realm, target),
+                'realm': realm, 'target': target,
+                'href': req.href(realm, target),
+                'label': '#%s' % target if realm == 'ticket' else target,
+                'summary': summary, 'exists': summary is not None})
+        return subscriptions
+
 
 class IrkerAdminModule(Component):
     """Implements the admin page for workflow editing.
@@ -74,18 +140,46 @@ class IrkerAdminModule(Component):
 
     irc_subscribers = ExtensionPoint(ISubscriptionInfoProvider)
 
+    items_per_page = IntOption('irker', 'admin_items_per_page', 50,
+                               doc="""Number of subscriptions listed on a
+                               page of the Irker Notifications admin panel.
+                               """)
+
     # helper functions
     def _get_subscription_info(self):
+        counts = SubscriptionHandler.count_subscriptions_by_class(self.env)
         subscribers = {}
         for subscriber in self.irc_subscribers:
-            name, desc, configurable, subs = subscriber.get_subscription_info()
+            name, desc, configurable = subscriber.get_subscription_info()
             rule = {}
             rule['desc'] = desc
-            rule['subs'] = subs
             rule['conf'] = configurable
+            rule['count'] = counts.get(name, 0)
             subscribers[name] = rule
         return subscribers
 
+    def _get_subscription_page(self, req, cat, page, name):
+        """Query only the requested page of the subscriptions of a class."""
+        sid_filter = req.args.get('sid', '').strip()
+        resource_filter = req.args.get('resource', '').strip()
+        pagenum = req.args.getint('page', 1, min=1)
+        max_per_page = max(self.items_per_page, 1)
+        num_items = SubscriptionHandler.\
+            count_subscriptions(self.env, name, sid_filter, resource_filter)
+        subs = SubscriptionHandler.\
+            find_subscriptions(self.env, name, sid_filter, resource_filter,
+                               max_per_page, (pagenum - 1) * max_per_page)
+
+        def page_href(pagenum):
+            return req.href.admin(cat, page, name, sid=sid_filter or None,
+                                  resource=resource_filter or None,
+                                  page=pagenum)
+
+        paginator = _paginate(req, subs, pagenum, max_per_page, num_items,
+                              page_href)
+        return {'name': name, 'subs': subs, 'paginator': paginator,
+                'sid_filter': sid_filter, 'resource_filter': resource_filter}
+
     def _get_validated_subscriptions(self, subscriptions, subscription_type):
         # for tickets only accept positive integers
         if subscription_type == 'ticket':
@@ -98,36 +192,29 @@ class IrkerAdminModule(Component):
         subs = ['/%s/%s' % (subscription_type, x) for x in filtered_subs]
         return set(subs)
 
-    def _save_subscribers(self, subscribers, req):
-        for name, subscriber in subscribers.iteritems():
-            # if subscriber class is not configurable do not display it
-            # in the table
-            if not subscriber['conf']:
-                continue
-            updated_subs = [x.strip() for x in
-                            req.args.get('subscribers_%s' % name)
-                            .split(',')]
-            unhandled_subs = updated_subs
-            prev_subs = subscriber['subs']
-            # iterate through previous subscriptions
-            for subscriber_id, sub_id in prev_subs:
-                self.log.\
-                    debug('Subscriber removed from %s: %s' %
-                          (name, subscriber_id))
-                # if subscription is preserved just mark it as handled
-                if subscriber_id in updated_subs:
-                    unhandled_subs.remove(subscriber_id)
-                # otherwise delete subscription
-                else:
-                    Subscription.delete(self.env, sub_id)
-                    SubscriptionHandler.\
-                        remove_all_subscriptions(self.env, self.log,
-                                                 subscriber_id)
-            for sub in unhandled_subs:
+    def _is_subscribed(self, sid, name):
+        return len(Subscription.find_by_sids_and_class(self.env, ((sid, 1),),
+                                                       name)) != 0
+
+    def _save_subscribers(self, name, req):
+        new_subs = [x.strip() for x in
+                    req.args.get('subscribers', '').split(',') if x.strip()]
+        for sub in new_subs:
+            if not self._is_subscribed(sub, name):
                 SubscriptionHandler.\
                     add_subscription(self.env, self.log, sub, name)
+        for subscriber_id in req.args.getlist('sel'):
+            # only the selected subscriptions are deleted
+            for sub in Subscription.\
+                    find_by_sids_and_class(self.env, ((subscriber_id, 1),),
+                                           name):
+                Subscription.delete(self.env, sub['id'])
+            SubscriptionHandler.\
+                remove_all_subscriptions(self.env, self.log, subscriber_id)
+            self.log.debug('Subscriber removed from %s: %s' %
+                           (name, subscriber_id))
 
-    def _add_subscribers(self, subscribers, req):
+    def _add_subscribers(self, req):
         added_subscriptions = self.\
             _get_validated_subscriptions(req.args.get('subscriptions'),
                                          req.args.get('subs_type'))
@@ -141,30 +228,19 @@ class IrkerAdminModule(Component):
         else:
             new_subs = [x.strip() for x in req.args.get('subscribers')
                         .split(',')]
-            res_subscriber = subscribers['ResourceChangeIrcSubscriber']
-            current_subs = res_subscriber['subs']
             # iterate throught new subscribers
             for subscriber_id in new_subs:
                 # if it is not subscribed already
-                if subscriber_id not in [sid for sid,
-                                         id in current_subs]:
+                if not self._is_subscribed(subscriber_id,
+                                           'ResourceChangeIrcSubscriber'):
                     SubscriptionHandler.\
                         add_subscription(self.env, self.log, subscriber_id,
                                          'ResourceChangeIrcSubscriber')
                 # update session specific resource subscriptions
-                session_subs = SubscriptionHandler.\
-                    get_session_subscriptions(self.env, subscriber_id)
-                session_subs_is_empty = len(session_subs) == 0
-                existing_subscriptions = set()
-                if not session_subs_is_empty:
-                    existing_subscriptions = \
-                        set([x.strip() for x in session_subs.split(',')])
                 SubscriptionHandler.\
-                    update_subscriptions(self.env, self.log, subscriber_id,
-                                         ', '.join(list(
-                                                    existing_subscriptions |
-                                                    added_subscriptions)),
-                                         session_subs_is_empty)
+                    add_resource_subscriptions(self.env, self.log,
+                                               subscriber_id,
+                                               added_subscriptions)
                 add_notice(req, _('Subscriptions have been added.'))
 
     # IAdminPanelProvider methods
@@ -177,32 +253,36 @@ class IrkerAdminModule(Component):
         req.perm.assert_permission('TICKET_ADMIN')
 
         subscribers = self._get_subscription_info()
-
-        data = {'subscribers': subscribers}
-        if req.method == "GET":
-            return ('irker_admin.html', data)
+        if path_info and path_info not in subscribers:
+            raise ResourceNotFound(_("Subscriber class %(name)s does not "
+                                     "exist.", name=path_info))
 
         if req.method == 'POST':
-            if req.args.get('save'):  # save changes from table
-                self._save_subscribers(subscribers, req)
+            if req.args.get('save') and path_info:  # save changes of class
+                if subscribers[path_info]['conf']:
+                    self._save_subscribers(path_info, req)
+                    add_notice(req, _('Your changes have been saved.'))
             if req.args.get('remove'):  # remove subscriptions from user
-                if len(req.args.get('name')) == 0:
+                name = req.args.get('name', '').strip()
+                if len(name) == 0:
                     add_warning(req, _('Name field cannot be empty.'))
                 else:
                     subs_to_remove = Subscription.\
-                        find_by_sid_and_distributor(self.env,
-                                                    req.args.get('name'), 1,
-                                                    'irc')
+                        find_by_sid_and_distributor(self.env, name, 1, 'irc')
                     for sub in subs_to_remove:
                         Subscription.delete(self.env, sub['id'])
-                        SubscriptionHandler.\
-                            remove_all_subscriptions(self.env,
-                                                     self.log, subscriber_id)
+                    SubscriptionHandler.\
+                        remove_all_subscriptions(self.env, self.log, name)
                     add_notice(req, _('Subscriptions have been removed.'))
             if req.args.get('addsubs'):  # add new subscriptions
-                self._add_subscribers(subscribers, req)
+                self._add_subscribers(req)
+            subscribers = self._get_subscription_info()
 
-        data = {'subscribers': self._get_subscription_info()}
+        data = {'subscribers': subscribers}
+        if path_info:
+            data['subscriber'] = subscribers[path_info]
+            data.update(self._get_subscription_page(req, cat, page,
+                                                    path_info))
         return ('irker_admin.html', data)
 
     # ITemplateProvider methods
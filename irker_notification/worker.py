@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2017 Miklos Molnar
+#
+# All rights reserved.
+#
+# This software is licensed as described in the file README.md, which
+# you should have received as part of this distribution.
+
+import atexit
+import threading
+from collections import namedtuple
+from Queue import Full, Queue
+
+from trac.cache import CacheManager
+from trac.config import BoolOption, IntOption
+from trac.core import Component
+from trac.util.text import exception_to_unicode
+
+
+# Lightweight record of a wiki change, the page is only reloaded by the
+# worker thread.
+WikiEventRecord = namedtuple('WikiEventRecord',
+                             'category name version time author comment')
+
+# Lightweight record of an added changeset, kept until the push is over.
+ChangesetRecord = namedtuple('ChangesetRecord', 'rev author date message')
+
+
+class IrkerNotificationWorker(Component):
+    """Processes notification events in a background thread, so that the
+    request only pays for putting a record into a queue."""
+
+    asynchronous = \
+        BoolOption('irker', 'async_notification', 'true',
+                   doc="""Process the irc notifications in a background
+                   thread. If disabled, notifications are processed
+                   synchronously, which is useful for testing.""")
+
+    queue_size = \
+        IntOption('irker', 'queue_size', 1000,
+                  doc="""Maximum number of events waiting for the
+                  background thread. When the queue is full, events are
+                  processed synchronously.""")
+
+    def __init__(self):
+        self._thread_name = 'IrkerNotificationWorker-%s' % id(self)
+        self._queue = None
+        self._thread = None
+        self._stopped = False
+        self._lock = threading.Lock()
+
+    def enqueue(self, handler, record):
+        """Process `record` by calling `handler(record)` in the worker
+        thread, or immediately in synchronous mode, and once the
+        thread has been stopped at exit."""
+        if not self.asynchronous or self._stopped:
+            self._process(handler, record)
+            return
+        try:
+            self._get_queue().put_nowait((handler, record))
+        except Full:
+            self.log.warning("IrkerNotificationWorker queue is full, "
+                             "processing %r synchronously", record)
+            self._process(handler, record)
+
+    def in_worker_thread(self):
+        """Return whether the caller runs in the worker thread."""
+        return threading.current_thread().name == self._thread_name
+
+    def join(self):
+        """Block until every queued record has been processed."""
+        if self._queue is not None:
+            self._queue.join()
+
+    # helper functions
+    def _get_queue(self):
+        with self._lock:
+            if self._queue is None:
+                self._queue = Queue(max(self.queue_size, 1))
+                self._thread = threading.Thread(target=self._run,
+                                                name=self._thread_name)
+                self._thread.daemon = True
+                self._thread.start()
+                # trac-admin commands exit right after the change, let
+                # the pending notifications go out first
+                atexit.register(self._shutdown)
+            return self._queue
+
+    def _shutdown(self):
+        # later records, e.g. of the other exit functions, are processed
+        # by their caller
+        self._stopped = True
+        self._queue.put((None, None))
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            handler, record = self._queue.get()
+            try:
+                if handler is None:
+                    break
+                # like a request, see the cache invalidations of other
+                # threads and processes
+                CacheManager(self.env).reset_metadata()
+                self._process(handler, record)
+            finally:
+                self._queue.task_done()
+
+    def _process(self, handler, record):
+        try:
+            handler(record)
+        except Exception as e:
+            self.log.error("IrkerNotificationWorker failed to process %r: "
+                           "%s", record, exception_to_unicode(e,
+                                                              traceback=True))
@@ -7,13 +7,32 @@ setup(
     author='Southen,scifimiki',
     url='https://github.com/scifimiki/trac-irker-plugin',
     license='BSD',
-    packages=['irker_notification'],
+    packages=['irker_notification', 'irker_notification.tests'],
     package_data={'irker_notification': ['templates/*']},
+    test_suite='irker_notification.tests.test_suite',
     classifiers=[
         'Framework :: Trac',
         'License :: OSI Approved :: BSD License',
     ],
     entry_points={
-        'trac.plugins': 'irker_notification = irker_notification'
+        'trac.plugins': [
+            'irker_notification.admin = irker_notification.admin',
+            'irker_notification.distribution = '
+            'irker_notification.distribution',
+            'irker_notification.groups = irker_notification.groups',
+            'irker_notification.journal = irker_notification.journal',
+            'irker_notification.notification = '
+            'irker_notification.notification',
+            'irker_notification.recipients = '
+            'irker_notification.recipients',
+            'irker_notification.subscription = '
+            'irker_notification.subscription',
+            'irker_notification.tracing = irker_notification.tracing',
+            'irker_notification.web_ui = irker_notification.web_ui',
+            'irker_notification.worker = irker_notification.worker',
+        ],
+        'console_scripts': [
+            'irker-relay = irker_notification.relay:main',
+        ],
     }
 )